@@ -1,8 +1,17 @@
 import json
+import math
 import os
+import time
+from urllib.parse import quote
 from flask import Flask, render_template, request
 from flask_cors import CORS
+from sqlalchemy import exc
+from helpers.InvertedIndex import InvertedIndex
+from helpers.LatencyRecorder import LatencyRecorder
 from helpers.MySQLDatabaseHandler import MySQLDatabaseHandler
+from helpers.ResultCache import ResultCache
+from helpers.SearchEngine import SearchEngine
+from helpers.Tokenizer import Tokenizer
 
 # ROOT_PATH for linking with all your files. 
 # Feel free to use a config.py or settings.py with a global export variable
@@ -19,28 +28,166 @@ LOCAL_MYSQL_DATABASE = "kardashiandb"
 mysql_engine = MySQLDatabaseHandler(LOCAL_MYSQL_USER,LOCAL_MYSQL_USER_PASSWORD,LOCAL_MYSQL_PORT,LOCAL_MYSQL_DATABASE)
 
 # Path to init.sql file. This file can be replaced with your own file for testing on localhost, but do NOT move the init.sql file
-mysql_engine.load_file_into_db()
+# The file is only reloaded when it changed since the last start; set FORCE_DB_RELOAD=1 to rebuild every table from it
+mysql_engine.load_file_into_db(force = os.environ.get("FORCE_DB_RELOAD") == "1")
+
+# Search columns and indexes on episodes, mirroring the end of init.sql for databases built before they existed.
+# title_norm only lowercases the title; its values keep their accents, and it is the utf8mb4_unicode_ci collation
+# that makes comparisons against it (and its index) accent- and case-insensitive
+mysql_engine.ensure_schema("episodes",
+    columns = {"title_norm": "ALTER TABLE episodes ADD COLUMN title_norm varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci GENERATED ALWAYS AS (LOWER(title)) STORED"},
+    indexes = {
+        "PRIMARY": "ALTER TABLE episodes ADD PRIMARY KEY (id)",
+        "idx_episodes_title_norm": "CREATE INDEX idx_episodes_title_norm ON episodes (title_norm)",
+        "ft_episodes_title": "CREATE FULLTEXT INDEX ft_episodes_title ON episodes (title)",
+        "ft_episodes_descr": "CREATE FULLTEXT INDEX ft_episodes_descr ON episodes (descr)",
+        "ft_episodes_title_descr": "CREATE FULLTEXT INDEX ft_episodes_title_descr ON episodes (title, descr)",
+    })
+
+# In-memory index over episodes, built in the background; /episodes uses SQL until it is ready.
+# Writes through mysql_engine.query_executor are applied to it as they commit
+search_engine = SearchEngine(mysql_engine)
+mysql_engine.watch("episodes", search_engine.apply_changes)
+search_engine.start()
+latency = LatencyRecorder()
+
+# Serialized /episodes responses by normalized query; emptied by every write to episodes and whenever
+# search_engine finishes a build or merge, since results served before may be stale or lack their did-you-mean
+result_cache = ResultCache()
+mysql_engine.watch("episodes", result_cache.invalidate)
+search_engine.watch(result_cache.invalidate)
+tokenizer = Tokenizer()
 
 app = Flask(__name__)
 CORS(app)
 
-# Sample search, the LIKE operator in this case is hard-coded, 
-# but if you decide to use SQLAlchemy ORM framework, 
-# there's a much better and cleaner way to do this
-def sql_search(episode):
-    query_sql = f"""SELECT * FROM episodes WHERE LOWER( title ) LIKE '%%{episode.lower()}%%' limit 10"""
+# Sample search. The statement text is fixed and the user input travels as bound parameters,
+# so quotes in the input are harmless and SQLAlchemy compiles the statement only once.
+# title_norm is LOWER(title), accents included; the column's utf8mb4_unicode_ci collation is what makes "khloe" LIKE "khloé" match
+TITLE_SEARCH_SQL = """SELECT id, title, descr FROM episodes WHERE title_norm LIKE :pattern LIMIT :limit"""
+
+# Relevance-ranked search served by the FULLTEXT index on (title, descr)
+FULLTEXT_SEARCH_SQL = """SELECT id, title, descr, MATCH(title, descr) AGAINST (:query IN {mode}) AS score
+    FROM episodes WHERE MATCH(title, descr) AGAINST (:query IN {mode}) ORDER BY score DESC LIMIT :limit"""
+
+def sql_search(episode, limit = 10):
+    pattern = "%" + MySQLDatabaseHandler.escape_like(episode.lower()) + "%"
     keys = ["id","title","descr"]
-    data = mysql_engine.query_selector(query_sql)
+    data = mysql_engine.query_selector(mysql_engine.prepared(TITLE_SEARCH_SQL), {"pattern": pattern, "limit": limit})
+    return json.dumps([dict(zip(keys,i)) for i in data])
+
+def fulltext_search(query, boolean = False, limit = 10):
+    mode = "BOOLEAN MODE" if boolean else "NATURAL LANGUAGE MODE"
+    keys = ["id","title","descr","score"]
+    data = mysql_engine.query_selector(mysql_engine.prepared(FULLTEXT_SEARCH_SQL.format(mode = mode)), {"query": query, "limit": limit})
     return json.dumps([dict(zip(keys,i)) for i in data])
 
 @app.route("/")
 def home():
     return render_template('base.html',title="sample html")
 
+def cache_key(text, path, options):
+    # Case and accents never change the results, and on the term-based modes punctuation does not either.
+    # A trailing space still counts there: it ends the last term for index mode and for suggestions.
+    # fulltext and queries with phrases or NEAR/k key on the raw text, since their operators are punctuation.
+    if path == "substring" or path == "sql":
+        normalized = tokenizer.normalize(text)
+    elif path in SearchEngine.MODES and not InvertedIndex.is_structured(text):
+        normalized = " ".join(tokenizer.tokenize(text)) + (" " if text[-1:].isspace() else "")
+    else:
+        normalized = text
+    return (path, normalized, tuple(sorted(options.items())))
+
 @app.route("/episodes")
 def episodes_search():
-    text = request.args.get("title")
-    return sql_search(text)
+    text = request.args.get("title", "")
+    mode = request.args.get("mode", "index")
+    options = {}
+    if mode in SearchEngine.MODES and search_engine.available(mode):
+        path = mode
+        options = {name: request.args.get(name, type = float) for name in SearchEngine.OPTIONS.get(mode, ()) if name in request.args}
+        # request.args.get gives None for a value that is not a number; nan/inf would poison the scores
+        invalid = [name for name, value in options.items() if value is None or not math.isfinite(value)]
+        if invalid:
+            return json.dumps({"error": f"{', '.join(invalid)} must be a number"}), 400
+        # snippets=1 sends a highlighted window of each description instead of all of it
+        if request.args.get("snippets") == "1":
+            options["snippets"] = True
+    elif mode in ("fulltext", "fulltext_boolean"):
+        path = mode
+    else:
+        path = "sql"
+    key = cache_key(text, path, options)
+    started = time.perf_counter()
+    cached = result_cache.get(key)
+    if cached is not None:
+        latency.record("cache", time.perf_counter() - started)
+        return cached[0], 200, cached[1]
+    generation = result_cache.generation
+    headers = {}
+    with latency.timed(path):
+        if path in SearchEngine.MODES:
+            try:
+                results = search_engine.search(text, mode, **options)
+            except ValueError as e:
+                return json.dumps({"error": str(e)}), 400
+            suggestion = search_engine.suggest(text)
+            # Misspelled queries that match nothing are answered for the corrected query instead
+            if not results and suggestion is not None:
+                results = search_engine.search(suggestion, mode, **options)
+            if suggestion is not None:
+                headers["X-Did-You-Mean"] = quote(suggestion)
+            body = json.dumps(results)
+        elif path == "sql":
+            body = sql_search(text)
+        else:
+            try:
+                body = fulltext_search(text, boolean = mode == "fulltext_boolean")
+            except (exc.ProgrammingError, exc.OperationalError) as e:
+                # MySQL rejects malformed boolean-mode operators ("+", an unterminated quote) as syntax errors
+                if mode != "fulltext_boolean":
+                    raise
+                return json.dumps({"error": f"invalid boolean query: {e.orig}"}), 400
+    result_cache.put(key, body, headers, generation)
+    return body, 200, headers
+
+@app.route("/episodes/<int:episode_id>/similar")
+def similar_episodes(episode_id):
+    with latency.timed("similar"):
+        results = search_engine.similar(episode_id, request.args.get("limit", 10, type = int))
+    if results is None:
+        return json.dumps([]), 404
+    return json.dumps(results)
+
+# bm25f field boosts, e.g. POST /field_weights?title=3&descr=1; cached responses ranked with the old ones are dropped.
+# Development only: changes reach just the worker process serving the request (and its cache), and CORS lets any
+# origin call this, so POST answers 403 unless ALLOW_FIELD_WEIGHTS=1. Deployed weights belong in SearchEngine(field_weights = ...).
+@app.route("/field_weights", methods = ["GET", "POST"])
+def field_weights():
+    if request.method == "GET":
+        return json.dumps(search_engine.field_weights)
+    if os.environ.get("ALLOW_FIELD_WEIGHTS") != "1":
+        return json.dumps({"error": "changing field weights is disabled, set ALLOW_FIELD_WEIGHTS=1 to enable it"}), 403
+    weights = dict(request.args.items())
+    weights.update(request.get_json(silent = True) or {})
+    try:
+        updated = search_engine.set_field_weights({field: float(weight) for field, weight in weights.items()})
+    except (TypeError, ValueError) as e:
+        return json.dumps({"error": str(e)}), 400
+    result_cache.invalidate()
+    return json.dumps(updated)
+
+@app.route("/autocomplete")
+def autocomplete():
+    prefix = request.args.get("q", "")
+    if not prefix.strip():
+        return json.dumps([])
+    with latency.timed("autocomplete"):
+        return json.dumps(search_engine.complete(prefix, request.args.get("limit", 10, type = int)))
+
+@app.route("/stats")
+def stats():
+    return json.dumps({"pool": mysql_engine.pool_stats(), "statements": mysql_engine.statement_stats(), "latency": latency.snapshot(), "search": search_engine.stats(), "cache": result_cache.stats()})
 
 if 'DB_NAME' not in os.environ:
     app.run(debug=True,host="0.0.0.0",port=5000)
\ No newline at end of file
@@ -0,0 +1,213 @@
+import heapq
+import math
+from bisect import bisect_left
+from collections import Counter
+
+class PostingsCursor(object):
+    """Position in one query term's postings during document-at-a-time WAND traversal."""
+
+    __slots__ = ("order", "postings", "weight", "bound", "position", "docno")
+
+    def __init__(self, order, postings, weight, bound):
+        self.order = order
+        self.postings = postings
+        self.weight = weight
+        self.bound = bound
+        self.position = 0
+        self.docno = postings.docnos[0]
+
+    def advance_to(self, target):
+        """Moves to the first posting >= target and returns how many postings were skipped over."""
+        docnos = self.postings.docnos
+        position = bisect_left(docnos, target, self.position)
+        skipped = position - self.position
+        self.position = position
+        self.docno = docnos[position] if position < len(docnos) else None
+        return skipped
+
+class BM25Scorer(object):
+    """BM25 and BM25F ranking over an InvertedIndex.
+
+    Everything that depends only on the corpus is computed once per index
+    version: each document's length divided by the average length, per field
+    and for the whole document, on the first query after a write; per-term IDF
+    and score bounds the first time a query uses the term. A query only applies k1/b to those ratios for the documents
+    in the postings of its own terms.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    # Default BM25F boosts; a title match counts twice as much as one in the description
+    FIELD_WEIGHTS = {"title": 2.0, "descr": 1.0}
+
+    def __init__(self, index, field_weights = None):
+        self.index = index
+        self.tokenizer = index.tokenizer
+        self.field_weights = dict(field_weights or BM25Scorer.FIELD_WEIGHTS)
+        self.version = None
+        self._refresh()
+
+    def _refresh(self):
+        """Recomputes the corpus statistics after the index has been written to (tombstoned documents do not count)."""
+        if self.version == self.index.version:
+            return
+        index = self.index
+        live = len(index) - len(index.deleted)
+        self.field_avg_lengths = [(sum(lengths) - sum(lengths[docno] for docno in index.deleted)) / max(live, 1) for lengths in index.field_lengths]
+        self.field_length_ratios = [[length / max(avg, 1e-9) for length in lengths] for lengths, avg in zip(index.field_lengths, self.field_avg_lengths)]
+        doc_lengths = [sum(lengths) for lengths in zip(*index.field_lengths)]
+        avg_length = (sum(doc_lengths) - sum(doc_lengths[docno] for docno in index.deleted)) / max(live, 1)
+        self.length_ratios = [length / max(avg_length, 1e-9) for length in doc_lengths]
+        self.term_stats = {}
+        self.version = index.version
+
+    def _term_stats(self, term, postings):
+        """(idf, max tf, min length ratio, exact max contribution at the default k1/b), computed once per term.
+
+        BM25's term contribution grows with tf and shrinks with document length, so the largest tf and the
+        shortest document in a term's postings bound its contribution for any k1/b chosen at query time.
+        The exact maximum for the default k1/b prunes far more and is what WAND normally uses.
+        """
+        stats = self.term_stats.get(term)
+        if stats is None:
+            ratios = self.length_ratios
+            df = self.index.df(term)
+            idf = math.log(1 + (self.index.live_count() - df + 0.5) / (df + 0.5))
+            live = [(docno, tf) for docno, tf in zip(postings.docnos, postings.tfs) if docno not in self.index.deleted] or [(0, 0)]
+            default_bound = max(tf * (BM25Scorer.K1 + 1) / (tf + BM25Scorer.K1 * (1 - BM25Scorer.B + BM25Scorer.B * ratios[docno]))
+                                for docno, tf in live)
+            stats = self.term_stats[term] = (idf, max(tf for _, tf in live), min(ratios[docno] for docno, _ in live), default_bound)
+        return stats
+
+    def rank(self, query, limit = 10, k1 = K1, b = B):
+        """Plain BM25 over the concatenated title and description."""
+        self._refresh()
+        scores = {}
+        ratios = self.length_ratios
+        for term, qtf in Counter(self.tokenizer.tokenize(query)).items():
+            postings = self.index.postings.get(term)
+            if postings is None:
+                continue
+            idf = self._term_stats(term, postings)[0] * qtf
+            for docno, tf in zip(postings.docnos, postings.tfs):
+                scores[docno] = scores.get(docno, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * ratios[docno]))
+        for docno in self.index.deleted.intersection(scores):
+            del scores[docno]
+        return heapq.nlargest(limit, scores.items(), key = lambda item: (item[1], -item[0]))
+
+    def rank_wand(self, query, limit = 10, k1 = K1, b = B, stats = None):
+        """Same ranking as rank(), computed with WAND dynamic pruning.
+
+        Cursors are kept ordered by their current docno; the pivot is the first
+        cursor at which the summed term upper bounds exceed the score of the
+        current k-th result, and every document before the pivot is skipped
+        without being scored. Pass a dict as stats to receive the number of
+        documents evaluated and postings skipped.
+        """
+        self._refresh()
+        ratios = self.length_ratios
+        deleted = self.index.deleted
+        cursors = []
+        for term, qtf in Counter(self.tokenizer.tokenize(query)).items():
+            postings = self.index.postings.get(term)
+            if postings is None:
+                continue
+            idf, max_tf, min_ratio, default_bound = self._term_stats(term, postings)
+            weight = idf * qtf
+            if k1 == BM25Scorer.K1 and b == BM25Scorer.B:
+                bound = weight * default_bound * (1 + 1e-9)
+            else:
+                bound = weight * max_tf * (k1 + 1) / (max_tf + k1 * (1 - b + b * min_ratio)) * (1 + 1e-9)
+            cursors.append(PostingsCursor(len(cursors), postings, weight, bound))
+        top = []
+        evaluated = skipped = 0
+        while cursors:
+            cursors.sort(key = lambda cursor: cursor.docno)
+            # Documents arrive in docno order and ties keep the lower docno, so a new document must beat the k-th score strictly
+            threshold = top[0][0] if len(top) == limit else 0.0
+            reach = 0.0
+            pivot = None
+            for i, cursor in enumerate(cursors):
+                reach += cursor.bound
+                if reach > threshold:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            pivot_docno = cursors[pivot].docno
+            if cursors[0].docno == pivot_docno and pivot_docno in deleted:
+                for cursor in cursors:
+                    if cursor.docno == pivot_docno:
+                        cursor.advance_to(pivot_docno + 1)
+            elif cursors[0].docno == pivot_docno:
+                matched = sorted((cursor for cursor in cursors if cursor.docno == pivot_docno), key = lambda cursor: cursor.order)
+                score = 0.0
+                ratio = 1 - b + b * ratios[pivot_docno]
+                for cursor in matched:
+                    tf = cursor.postings.tfs[cursor.position]
+                    score += cursor.weight * tf * (k1 + 1) / (tf + k1 * ratio)
+                evaluated += 1
+                if len(top) < limit:
+                    heapq.heappush(top, (score, -pivot_docno))
+                elif score > threshold:
+                    heapq.heapreplace(top, (score, -pivot_docno))
+                for cursor in matched:
+                    cursor.advance_to(pivot_docno + 1)
+            else:
+                for cursor in cursors[:pivot]:
+                    skipped += cursor.advance_to(pivot_docno)
+            cursors = [cursor for cursor in cursors if cursor.docno is not None]
+        if stats is not None:
+            stats["evaluated"] = stats.get("evaluated", 0) + evaluated
+            stats["skipped_postings"] = stats.get("skipped_postings", 0) + skipped
+        return [(-negative_docno, score) for score, negative_docno in sorted(top, reverse = True)]
+
+    def rank_proximity(self, query, limit = 10, proximity = 1.0, k1 = K1, b = B, depth = 100):
+        """BM25 re-ranked with a term proximity bonus.
+
+        The top depth BM25 documents gain, for every pair of distinct query
+        terms, proximity * min(idf) / d^2 where d is the smallest distance
+        between the two terms in the document (Rasolofo and Savoy), so a
+        document using the query terms next to each other beats one that
+        mentions them in unrelated sentences.
+        """
+        ranked = self.rank_wand(query, max(limit, depth), k1, b)
+        terms = [term for term in dict.fromkeys(self.tokenizer.tokenize(query)) if term in self.index.postings]
+        if len(terms) < 2:
+            return ranked[:limit]
+        idfs = {term: self._term_stats(term, self.index.postings[term])[0] for term in terms}
+        rescored = []
+        for docno, score in ranked:
+            positions = {term: self.index.positions(term, docno) for term in terms}
+            for i, a in enumerate(terms):
+                for other in terms[i + 1:]:
+                    distance = self.index.min_distance(positions[a], positions[other])
+                    if distance:
+                        score += proximity * min(idfs[a], idfs[other]) / (distance * distance)
+            rescored.append((docno, score))
+        return heapq.nlargest(limit, rescored, key = lambda item: (item[1], -item[0]))
+
+    def rank_fields(self, query, limit = 10, k1 = K1, b = B, field_weights = None):
+        """BM25F: per-field length-normalized frequencies are weighted and summed before saturation.
+
+        field_weights overrides self.field_weights for this query only; both
+        are read per query, so changing them needs no rebuild.
+        """
+        self._refresh()
+        weights = self.field_weights if field_weights is None else dict(self.field_weights, **field_weights)
+        fields = [(weights.get(name, 1.0), ratios) for name, ratios in zip(self.index.FIELDS, self.field_length_ratios)]
+        scores = {}
+        for term, qtf in Counter(self.tokenizer.tokenize(query)).items():
+            postings = self.index.postings.get(term)
+            if postings is None:
+                continue
+            idf = self._term_stats(term, postings)[0] * qtf
+            for i, docno in enumerate(postings.docnos):
+                tf = 0.0
+                for (weight, ratios), field_tfs in zip(fields, postings.field_tfs):
+                    if field_tfs[i]:
+                        tf += weight * field_tfs[i] / (1 - b + b * ratios[docno])
+                scores[docno] = scores.get(docno, 0.0) + idf * tf / (k1 + tf)
+        for docno in self.index.deleted.intersection(scores):
+            del scores[docno]
+        return heapq.nlargest(limit, scores.items(), key = lambda item: (item[1], -item[0]))
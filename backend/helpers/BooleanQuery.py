@@ -0,0 +1,293 @@
+import heapq
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+from helpers.InvertedIndex import InvertedIndex
+
+class Term(object):
+    __slots__ = ("term",)
+
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return self.term
+
+class Phrase(object):
+    __slots__ = ("terms",)
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return '"' + " ".join(self.terms) + '"'
+
+class Near(object):
+    __slots__ = ("a", "b", "k")
+
+    def __init__(self, a, b, k):
+        self.a = a
+        self.b = b
+        self.k = k
+
+    def __repr__(self):
+        return f"{self.a} NEAR/{self.k} {self.b}"
+
+class And(object):
+    __slots__ = ("children",)
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "(" + " AND ".join(map(repr, self.children)) + ")"
+
+class Or(object):
+    __slots__ = ("children",)
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "(" + " OR ".join(map(repr, self.children)) + ")"
+
+class Not(object):
+    __slots__ = ("child",)
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return f"NOT {self.child!r}"
+
+class BooleanQuery(object):
+    """Parses and runs AND/OR/NOT queries with parentheses and "phrases" over an InvertedIndex.
+
+    Operators are upper case; adjacent operands are ANDed and `a NOT b` means
+    a AND NOT b, so `kim AND (paris OR mexico) NOT khloe` reads as expected.
+    `a NEAR/k b` binds tighter than any of them, as in index mode.
+    Parsed plans are cached by query string. Every node evaluates to an
+    ascending docno list: AND intersects its operands smallest first with
+    galloping search and subtracts its NOT operands the same way, OR merges
+    its operands with a heap, and a query that is only negative is
+    subtracted from every live document. Results are ranked like index mode,
+    by the summed term frequency of the positive terms.
+    """
+
+    TOKEN = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
+    NEAR = re.compile(r"NEAR/(\d+)$")
+
+    def __init__(self, tokenizer = None, cache_size = 1024):
+        self.tokenizer = tokenizer
+        self.plans = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_boolean(query):
+        return InvertedIndex.BOOLEAN.search(query) is not None
+
+    def plan(self, query):
+        plan = self.plans.get(query)
+        if plan is not None:
+            self.plans.move_to_end(query)
+            self.hits += 1
+            return plan
+        self.misses += 1
+        plan = self.parse(query)
+        self.plans[query] = plan
+        if len(self.plans) > self.cache_size:
+            self.plans.popitem(last = False)
+        return plan
+
+    def parse(self, query):
+        """Returns the AST of query, or None if it has no terms. Unbalanced parentheses are tolerated."""
+        self._tokens = BooleanQuery.TOKEN.findall(query)
+        self._position = 0
+        node = self._or()
+        while self._position < len(self._tokens):
+            # A stray ")": keep parsing what follows it
+            self._position += 1
+            rest = self._or()
+            node = rest if node is None else node if rest is None else And([node, rest])
+        return node
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _or(self):
+        children = [self._and()]
+        while self._peek() == "OR":
+            self._position += 1
+            children.append(self._and())
+        children = [child for child in children if child is not None]
+        return None if not children else children[0] if len(children) == 1 else Or(children)
+
+    def _and(self):
+        children = []
+        while self._peek() not in (None, ")", "OR"):
+            if self._peek() == "AND":
+                self._position += 1
+                continue
+            child = self._not()
+            if child is not None:
+                children.append(child)
+        return None if not children else children[0] if len(children) == 1 else And(children)
+
+    def _not(self):
+        if self._peek() in (None, ")", "AND", "OR"):
+            return None
+        if BooleanQuery.NEAR.match(self._peek()):
+            # NEAR/k without a left operand
+            self._position += 1
+            return None
+        if self._peek() == "NOT":
+            self._position += 1
+            child = self._not()
+            return None if child is None else Not(child)
+        return self._primary()
+
+    def _primary(self):
+        token = self._tokens[self._position]
+        self._position += 1
+        if token == "(":
+            node = self._or()
+            if self._peek() == ")":
+                self._position += 1
+            return node
+        terms = self.tokenizer.tokenize(token.strip('"'))
+        pairs = []
+        # a NEAR/2 b NEAR/3 c is (a NEAR/2 b) AND (b NEAR/3 c); a phrase operand contributes its nearest end
+        while self._peek() is not None and BooleanQuery.NEAR.match(self._peek()):
+            k = int(BooleanQuery.NEAR.match(self._peek()).group(1))
+            operand = self._tokens[self._position + 1] if self._position + 1 < len(self._tokens) else None
+            if operand is None or operand in ("(", ")", "AND", "OR", "NOT") or BooleanQuery.NEAR.match(operand):
+                self._position += 1
+                break
+            self._position += 2
+            right = self.tokenizer.tokenize(operand.strip('"'))
+            if terms and right:
+                pairs.append(Near(terms[-1], right[0], k))
+            terms = right
+        if pairs:
+            return pairs[0] if len(pairs) == 1 else And(pairs)
+        if not terms:
+            return None
+        return Term(terms[0]) if len(terms) == 1 else Phrase(terms)
+
+    def search(self, index, query, limit = 10):
+        plan = self.plan(query)
+        if plan is None:
+            return []
+        docnos = self.evaluate(index, plan)
+        scores = dict.fromkeys(docnos, 0)
+        scores.update(index._term_scores(set(BooleanQuery.positive_terms(plan)), scores))
+        return index.top(scores, limit)
+
+    @staticmethod
+    def positive_terms(node):
+        if isinstance(node, Term):
+            return [node.term]
+        if isinstance(node, Phrase):
+            return list(node.terms)
+        if isinstance(node, Near):
+            return [node.a, node.b]
+        if isinstance(node, Not):
+            return []
+        return [term for child in node.children for term in BooleanQuery.positive_terms(child)]
+
+    def evaluate(self, index, node):
+        """Ascending live docnos matching node."""
+        docnos = self._evaluate(index, node)
+        return [docno for docno in docnos if docno not in index.deleted] if index.deleted else docnos
+
+    def _evaluate(self, index, node):
+        if isinstance(node, Term):
+            postings = index.postings.get(node.term)
+            return [] if postings is None else postings.docnos
+        if isinstance(node, Phrase):
+            return index.phrase_docnos(node.terms)
+        if isinstance(node, Near):
+            return index.near_docnos(node.a, node.b, node.k)
+        if isinstance(node, Or):
+            return BooleanQuery.union([self._evaluate(index, child) for child in node.children])
+        if isinstance(node, Not):
+            return BooleanQuery.difference(list(index.live_docnos()), self._evaluate(index, node.child))
+        positive = [child for child in node.children if not isinstance(child, Not)]
+        negative = [child.child for child in node.children if isinstance(child, Not)]
+        positive.sort(key = lambda child: BooleanQuery.estimate(index, child))
+        docnos = list(index.live_docnos()) if not positive else self._evaluate(index, positive[0])
+        for child in positive[1:]:
+            if not docnos:
+                return []
+            docnos = BooleanQuery.intersect(docnos, self._evaluate(index, child))
+        for child in negative:
+            if not docnos:
+                break
+            docnos = BooleanQuery.difference(docnos, self._evaluate(index, child))
+        return docnos
+
+    @staticmethod
+    def estimate(index, node):
+        """Upper bound on the matches of node from document frequencies alone, so AND can start from its rarest operand."""
+        if isinstance(node, Term):
+            return index.df(node.term)
+        if isinstance(node, Phrase):
+            return min(index.df(term) for term in node.terms)
+        if isinstance(node, Near):
+            return min(index.df(node.a), index.df(node.b))
+        if isinstance(node, Or):
+            return sum(BooleanQuery.estimate(index, child) for child in node.children)
+        if isinstance(node, And):
+            return min(BooleanQuery.estimate(index, child) for child in node.children)
+        return len(index)
+
+    @staticmethod
+    def gallop(docnos, target, lo):
+        """First index >= lo with docnos[index] >= target, probing lo + 1, 2, 4, ... before a binary search."""
+        step = 1
+        hi = lo
+        while hi < len(docnos) and docnos[hi] < target:
+            lo = hi + 1
+            hi += step
+            step *= 2
+        return bisect_left(docnos, target, lo, min(hi, len(docnos)))
+
+    @staticmethod
+    def intersect(a, b):
+        """Ascending docnos in both a and b, galloping through the longer list."""
+        if len(a) > len(b):
+            a, b = b, a
+        result = []
+        position = 0
+        for docno in a:
+            position = BooleanQuery.gallop(b, docno, position)
+            if position == len(b):
+                break
+            if b[position] == docno:
+                result.append(docno)
+        return result
+
+    @staticmethod
+    def difference(a, b):
+        """Ascending docnos in a but not in b, galloping through b."""
+        result = []
+        position = 0
+        for docno in a:
+            position = BooleanQuery.gallop(b, docno, position)
+            if position == len(b) or b[position] != docno:
+                result.append(docno)
+        return result
+
+    @staticmethod
+    def union(lists):
+        """Ascending docnos in any of lists, merged through a heap."""
+        result = []
+        for docno in heapq.merge(*lists):
+            if not result or result[-1] != docno:
+                result.append(docno)
+        return result
+
+    def stats(self):
+        return {"plans": len(self.plans), "plan_cache_hits": self.hits, "plan_cache_misses": self.misses}
@@ -0,0 +1,76 @@
+from bisect import insort
+from helpers.Tokenizer import Tokenizer
+
+class TrieNode(object):
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children = {}
+        self.top = []
+
+class CompletionTrie(object):
+    """Prefix trie over episode titles for search-as-you-type completions.
+
+    Every title is inserted from each of its token boundaries ("brody in the
+    house", "in the house", ...), so a prefix of any title word completes it.
+    Each node caches its best k completions at build time, which makes a
+    lookup a walk down len(prefix) nodes plus a copy of at most k entries.
+    Completions that match from the first word rank above later-word matches,
+    then shorter titles first. delete() only tombstones a title, so a node
+    can come back with fewer than k completions until the trie is rebuilt.
+    """
+
+    def __init__(self, k = 10, tokenizer = None):
+        self.k = k
+        self.tokenizer = tokenizer or Tokenizer()
+        self.root = TrieNode()
+        self.titles = []
+        self.deleted = set()
+
+    @classmethod
+    def build(cls, rows, k = 10, tokenizer = None):
+        trie = cls(k, tokenizer)
+        for row in rows:
+            trie.add(row[0], row[1])
+        return trie
+
+    def add(self, doc_id, title):
+        docno = len(self.titles)
+        self.titles.append((doc_id, title))
+        terms = self.tokenizer.tokenize(title or "")
+        for start in range(len(terms)):
+            self._insert(" ".join(terms[start:]), (start, len(title), docno))
+
+    def delete(self, docno):
+        self.deleted.add(docno)
+
+    def _insert(self, key, rank):
+        node = self.root
+        self._offer(node, rank)
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = TrieNode()
+            node = child
+            self._offer(node, rank)
+
+    def _offer(self, node, rank):
+        docno = rank[2]
+        for i, held in enumerate(node.top):
+            if held[2] == docno:
+                if held <= rank:
+                    return
+                del node.top[i]
+                break
+        if len(node.top) < self.k or rank < node.top[-1]:
+            insort(node.top, rank)
+            del node.top[self.k:]
+
+    def complete(self, prefix, limit = None):
+        node = self.root
+        for char in " ".join(self.tokenizer.tokenize(prefix)):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        limit = self.k if limit is None else min(limit, self.k)
+        return [{"id": self.titles[rank[2]][0], "title": self.titles[rank[2]][1]} for rank in node.top if rank[2] not in self.deleted][:limit]
@@ -0,0 +1,86 @@
+from itertools import combinations
+
+class FuzzyTermIndex(object):
+    """Typo-tolerant vocabulary lookup using SymSpell-style deletion neighborhoods.
+
+    At build time every term's prefix (first prefix_length characters) is
+    stored under each string obtainable by deleting up to max_distance of its
+    characters. Two terms within edit distance d share such a deletion, so a
+    lookup only generates the deletions of the query term and verifies the
+    handful of terms filed under them, instead of scanning the vocabulary.
+    """
+
+    def __init__(self, max_distance = 2, prefix_length = 7):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.frequencies = {}
+        self.deletes = {}
+
+    @classmethod
+    def build(cls, frequencies, max_distance = 2, prefix_length = 7):
+        index = cls(max_distance, prefix_length)
+        for term, frequency in frequencies.items():
+            index.add(term, frequency)
+        return index
+
+    def add(self, term, frequency = 1):
+        if term in self.frequencies:
+            self.frequencies[term] += frequency
+            return
+        self.frequencies[term] = frequency
+        for deletion in self._deletions(term[:self.prefix_length], self.max_distance):
+            terms = self.deletes.get(deletion)
+            if terms is None:
+                self.deletes[deletion] = [term]
+            else:
+                terms.append(term)
+
+    def __contains__(self, term):
+        return term in self.frequencies
+
+    def _deletions(self, word, max_distance):
+        deletions = {word}
+        for distance in range(1, min(max_distance, len(word)) + 1):
+            for positions in combinations(range(len(word)), distance):
+                deletions.add("".join(char for i, char in enumerate(word) if i not in positions))
+        return deletions
+
+    def lookup(self, term, max_distance = None):
+        """Returns [(vocabulary term, distance, frequency)] within max_distance, closest then most frequent first."""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        if term in self.frequencies:
+            return [(term, 0, self.frequencies[term])]
+        seen = set()
+        matches = []
+        for deletion in self._deletions(term[:self.prefix_length], max_distance):
+            for candidate in self.deletes.get(deletion, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if abs(len(candidate) - len(term)) > max_distance:
+                    continue
+                distance = FuzzyTermIndex.edit_distance(term, candidate, max_distance)
+                if distance <= max_distance:
+                    matches.append((candidate, distance, self.frequencies[candidate]))
+        matches.sort(key = lambda match: (match[1], -match[2], match[0]))
+        return matches
+
+    def correct(self, term, max_distance = None):
+        matches = self.lookup(term, max_distance)
+        return matches[0][0] if matches else None
+
+    @staticmethod
+    def edit_distance(a, b, max_distance):
+        """Optimal string alignment distance (adjacent transpositions count once); max_distance + 1 once exceeded."""
+        previous2, previous = None, list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            current = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = 0 if a[i - 1] == b[j - 1] else 1
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+                if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    current[j] = min(current[j], previous2[j - 2] + 1)
+            if min(current) > max_distance:
+                return max_distance + 1
+            previous2, previous = previous, current
+        return previous[-1]
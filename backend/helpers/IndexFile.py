@@ -0,0 +1,344 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from helpers.InvertedIndex import InvertedIndex, Postings
+from helpers.Tokenizer import Tokenizer
+
+class IndexFileError(Exception):
+    pass
+
+class IndexFile(object):
+    """Versioned binary file holding an InvertedIndex, read back through mmap.
+
+    Layout: a fixed header (magic, version, counts, the CHECKSUM TABLE value of
+    the source table, a section table and two CRC32s), then the sections
+
+        TERM_OFFSETS  uint32[n_terms + 1] into TERM_BLOB
+        TERM_BLOB     sorted UTF-8 terms, concatenated
+        TERM_ENTRIES  (postings offset uint64, postings length uint32, df uint32) per term
+        POSTINGS      per term and document: varint docno gap, one varint tf per field,
+                      then the varint gaps between the term's tf positions
+        DOC_LENGTHS   uint32[n_fields][n_docs] token count per field
+        DOC_IDS       int64[n_docs] external id per docno
+        DOC_OFFSETS   uint64[n_docs + 1] into DOC_BLOB
+        DOC_BLOB      UTF-8 "title\\0descr" per document
+        TOKEN_STARTS  uint64[n_docs + 1] into TOKEN_OFFSETS
+        TOKEN_OFFSETS uint32 start, end character offsets of every token per document
+
+    Fixed-width arrays are native little-endian so they can be used in place.
+    The header CRC is always checked on open; the body CRC only with verify=True,
+    since checking it reads every page of the file.
+    """
+
+    MAGIC = b"EPIX"
+    VERSION = 3
+    SECTIONS = ("TERM_OFFSETS", "TERM_BLOB", "TERM_ENTRIES", "POSTINGS", "DOC_LENGTHS", "DOC_IDS", "DOC_OFFSETS", "DOC_BLOB",
+                "TOKEN_STARTS", "TOKEN_OFFSETS")
+    HEADER = struct.Struct("<4sHHIIq" + "QQ" * len(SECTIONS) + "I")
+    HEADER_CRC = struct.Struct("<I")
+    TERM_ENTRY = struct.Struct("<QII")
+
+    @staticmethod
+    def write(index, path, source_checksum = 0):
+        """Writes index to path atomically (temp file + rename) and returns the file size."""
+        terms = sorted(index.postings)
+        term_offsets = array("I", [0])
+        term_blob = bytearray()
+        term_entries = bytearray()
+        postings_blob = bytearray()
+        for term in terms:
+            term_blob += term.encode("utf-8")
+            term_offsets.append(len(term_blob))
+            postings = index.postings[term]
+            start = len(postings_blob)
+            IndexFile.encode_postings(postings, postings_blob)
+            term_entries += IndexFile.TERM_ENTRY.pack(start, len(postings_blob) - start, len(postings))
+        doc_lengths = array("I")
+        for lengths in index.field_lengths:
+            doc_lengths.extend(lengths)
+        doc_ids = array("q", (row[0] for row in index.rows))
+        doc_offsets = array("Q", [0])
+        doc_blob = bytearray()
+        for row in index.rows:
+            doc_blob += (row[1] + "\0" + row[2]).encode("utf-8")
+            doc_offsets.append(len(doc_blob))
+        token_starts = array("Q", [0])
+        token_offsets = array("I")
+        for docno in range(len(index.rows)):
+            token_offsets.extend(index.token_offsets(docno))
+            token_starts.append(len(token_offsets))
+        sections = [term_offsets.tobytes(), bytes(term_blob), bytes(term_entries), bytes(postings_blob),
+                    doc_lengths.tobytes(), doc_ids.tobytes(), doc_offsets.tobytes(), bytes(doc_blob),
+                    token_starts.tobytes(), token_offsets.tobytes()]
+        return IndexFile.write_sections(path, len(index.rows), len(terms), source_checksum, [[section] for section in sections])
+
+    @staticmethod
+    def encode_postings(postings, out, base = 0):
+        """Appends the POSTINGS encoding of postings to out, with base added to every docno."""
+        previous = -base
+        for i, docno in enumerate(postings.docnos):
+            Postings.encode_varint(docno - previous, out)
+            previous = docno
+            for field_tfs in postings.field_tfs:
+                Postings.encode_varint(field_tfs[i], out)
+            out += postings.positions[postings.position_offsets[i]:postings.position_offsets[i + 1]]
+
+    @staticmethod
+    def write_sections(path, n_docs, n_terms, source_checksum, sections):
+        """Writes a file from its SECTIONS, each an iterable of byte chunks, so none needs to be in memory at once.
+
+        The header goes in last, once the section offsets and the body CRC are
+        known. Written to a temp file and renamed; returns the file size.
+        """
+        if sys.byteorder != "little":
+            raise IndexFileError("index files are written little-endian")
+        table = []
+        body_crc = 0
+        tmp_path = path + ".tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with open(tmp_path, "wb") as index_file:
+            index_file.write(b"\0" * (IndexFile.HEADER.size + IndexFile.HEADER_CRC.size))
+            for chunks in sections:
+                index_file.write(b"\0" * (-index_file.tell() % 8))
+                start = index_file.tell()
+                for chunk in chunks:
+                    index_file.write(chunk)
+                    body_crc = zlib.crc32(chunk, body_crc)
+                table += [start, index_file.tell() - start]
+            size = index_file.tell()
+            header = IndexFile.HEADER.pack(IndexFile.MAGIC, IndexFile.VERSION, len(InvertedIndex.FIELDS), n_docs, n_terms,
+                                           source_checksum, *table, body_crc)
+            index_file.seek(0)
+            index_file.write(header)
+            index_file.write(IndexFile.HEADER_CRC.pack(zlib.crc32(header)))
+        os.replace(tmp_path, path)
+        return size
+
+    @staticmethod
+    def open(path, source_checksum = None, verify = False, tokenizer = None):
+        """Maps the file at path; raises IndexFileError if it is corrupt, from another version or stale."""
+        with open(path, "rb") as index_file:
+            try:
+                mapped = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+            except ValueError:
+                raise IndexFileError(f"{path} is empty")
+        return MappedIndex(mapped, source_checksum, verify, tokenizer)
+
+class MappedTerms(object):
+    """Read-only sorted term list backed by TERM_OFFSETS/TERM_BLOB, usable with bisect."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class MappedPostings(object):
+    """Term -> Postings mapping that decodes postings from the mapped file on first access (LRU-cached)."""
+
+    def __init__(self, terms, entries, blob, n_fields, cache_size = 4096):
+        self.terms = terms
+        self.entries = entries
+        self.blob = blob
+        self.n_fields = n_fields
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def __getitem__(self, term):
+        postings = self.get(term)
+        if postings is None:
+            raise KeyError(term)
+        return postings
+
+    def keys(self):
+        return iter(self.terms)
+
+    def items(self):
+        for i, term in enumerate(self.terms):
+            yield term, self._decode(i)
+
+    def df(self, term):
+        i = self._find(term)
+        return 0 if i is None else IndexFile.TERM_ENTRY.unpack_from(self.entries, i * IndexFile.TERM_ENTRY.size)[2]
+
+    def dfs(self):
+        """{term: df} for every term, read from TERM_ENTRIES in one pass without decoding any postings."""
+        return dict(zip(self.terms, (entry[2] for entry in IndexFile.TERM_ENTRY.iter_unpack(self.entries))))
+
+    def get(self, term, default = None):
+        with self.lock:
+            postings = self.cache.get(term)
+            if postings is not None:
+                self.cache.move_to_end(term)
+                return postings
+        i = self._find(term)
+        if i is None:
+            return default
+        postings = self._decode(i)
+        with self.lock:
+            self.cache[term] = postings
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last = False)
+        return postings
+
+    def _find(self, term):
+        i = bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def _decode(self, i):
+        offset, length, df = IndexFile.TERM_ENTRY.unpack_from(self.entries, i * IndexFile.TERM_ENTRY.size)
+        data = self.blob[offset:offset + length]
+        postings = Postings(self.n_fields)
+        values = []
+        value = shift = 0
+        for byte in data:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                values.append(value)
+                value = shift = 0
+        docno = 0
+        start = 0
+        while start < len(values):
+            docno += values[start]
+            field_tfs = values[start + 1:start + 1 + self.n_fields]
+            start += 1 + self.n_fields
+            tf = sum(field_tfs)
+            positions = []
+            position = 0
+            for gap in values[start:start + tf]:
+                position += gap
+                positions.append(position)
+            start += tf
+            postings.append(docno, field_tfs, positions)
+        return postings
+
+class MappedRows(object):
+    """Read-only (id, title, descr) sequence backed by DOC_IDS/DOC_OFFSETS/DOC_BLOB."""
+
+    def __init__(self, ids, offsets, blob):
+        self.ids = ids
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, docno):
+        if not 0 <= docno < len(self.ids):
+            raise IndexError(docno)
+        title, descr = str(self.blob[self.offsets[docno]:self.offsets[docno + 1]], "utf-8").split("\0", 1)
+        return self.ids[docno], title, descr
+
+    def __iter__(self):
+        for docno in range(len(self.ids)):
+            yield self[docno]
+
+class MappedIndex(InvertedIndex):
+    """InvertedIndex whose postings, lengths and rows stay in the mapped file.
+
+    Opening costs a header check and a few memoryview casts; postings are
+    decoded per term when a query touches them, and every process mapping the
+    same file shares its pages through the OS page cache. It is read-only:
+    call materialize() for an InvertedIndex that accepts add().
+    """
+
+    def __init__(self, mapped, source_checksum = None, verify = False, tokenizer = None):
+        self.tokenizer = tokenizer or Tokenizer()
+        self.mapped = mapped
+        view = memoryview(mapped)
+        size = IndexFile.HEADER.size
+        if len(mapped) < size + IndexFile.HEADER_CRC.size:
+            raise IndexFileError("index file is truncated")
+        header = IndexFile.HEADER.unpack_from(mapped, 0)
+        magic, version, n_fields, n_docs, n_terms, checksum = header[:6]
+        table = header[6:-1]
+        if magic != IndexFile.MAGIC or version != IndexFile.VERSION or n_fields != len(InvertedIndex.FIELDS):
+            raise IndexFileError(f"not a version {IndexFile.VERSION} index file")
+        if IndexFile.HEADER_CRC.unpack_from(mapped, size)[0] != zlib.crc32(view[:size]):
+            raise IndexFileError("index header checksum mismatch")
+        if source_checksum is not None and checksum != source_checksum:
+            raise IndexFileError("index file is stale: the source table has changed since it was built")
+        sections = {}
+        body_crc = 0
+        for name, offset, length in zip(IndexFile.SECTIONS, table[::2], table[1::2]):
+            if offset + length > len(mapped):
+                raise IndexFileError(f"index section {name} runs past the end of the file")
+            sections[name] = view[offset:offset + length]
+            if verify:
+                body_crc = zlib.crc32(sections[name], body_crc)
+        if verify and body_crc != header[-1]:
+            raise IndexFileError("index body checksum mismatch")
+        self.source_checksum = checksum
+        self.rows = MappedRows(sections["DOC_IDS"].cast("q"), sections["DOC_OFFSETS"].cast("Q"), sections["DOC_BLOB"])
+        self.postings = MappedPostings(MappedTerms(sections["TERM_OFFSETS"].cast("I"), sections["TERM_BLOB"]),
+                                       sections["TERM_ENTRIES"], sections["POSTINGS"], n_fields)
+        lengths = sections["DOC_LENGTHS"].cast("I")
+        self.field_lengths = tuple(lengths[i * n_docs:(i + 1) * n_docs] for i in range(n_fields))
+        self.token_starts = sections["TOKEN_STARTS"].cast("Q")
+        self.offsets = sections["TOKEN_OFFSETS"].cast("I")
+        if len(self.rows) != n_docs or len(self.postings) != n_terms or len(self.token_starts) != n_docs + 1:
+            raise IndexFileError("index section sizes do not match the header")
+        self._docnos = None
+        self.deleted = frozenset()
+        self.dead_df = {}
+        self.version = 0
+
+    @property
+    def docnos(self):
+        if self._docnos is None:
+            self._docnos = {doc_id: docno for docno, doc_id in enumerate(self.rows.ids)}
+        return self._docnos
+
+    def vocabulary(self):
+        return self.postings.terms
+
+    def document_frequencies(self):
+        return self.postings.dfs()
+
+    def token_offsets(self, docno):
+        return self.offsets[self.token_starts[docno]:self.token_starts[docno + 1]]
+
+    def add(self, row):
+        raise TypeError("MappedIndex is read-only; use materialize() to get a writable InvertedIndex")
+
+    def delete(self, doc_id):
+        raise TypeError("MappedIndex is read-only; use materialize() to get a writable InvertedIndex")
+
+    def materialize(self):
+        index = InvertedIndex(self.tokenizer)
+        index.rows = list(self.rows)
+        index.docnos = dict(self.docnos)
+        index.field_lengths = tuple(list(lengths) for lengths in self.field_lengths)
+        index.offsets = [array("I", self.token_offsets(docno)) for docno in range(len(self.rows))]
+        index.postings = dict(self.postings.items())
+        return index
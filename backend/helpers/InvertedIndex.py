@@ -0,0 +1,362 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from helpers.Tokenizer import Tokenizer
+
+class Postings(object):
+    """Documents containing a term, as parallel lists sorted by docno.
+
+    tfs holds the frequency over all fields, field_tfs one list per field in
+    InvertedIndex.FIELDS order. The term's positions in each document are
+    varint-encoded gaps, concatenated in positions; those of the i-th posting
+    are positions[position_offsets[i]:position_offsets[i + 1]].
+    """
+
+    __slots__ = ("docnos", "tfs", "field_tfs", "positions", "position_offsets")
+
+    def __init__(self, n_fields):
+        self.docnos = []
+        self.tfs = []
+        self.field_tfs = tuple([] for _ in range(n_fields))
+        self.positions = bytearray()
+        self.position_offsets = array("I", [0])
+
+    def append(self, docno, field_tfs, positions = ()):
+        self.docnos.append(docno)
+        self.tfs.append(sum(field_tfs))
+        for tfs, tf in zip(self.field_tfs, field_tfs):
+            tfs.append(tf)
+        previous = 0
+        for position in positions:
+            Postings.encode_varint(position - previous, self.positions)
+            previous = position
+        self.position_offsets.append(len(self.positions))
+
+    def positions_at(self, i):
+        """Positions of the term in the document of the i-th posting, ascending."""
+        positions = []
+        position = value = shift = 0
+        for byte in self.positions[self.position_offsets[i]:self.position_offsets[i + 1]]:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                position += value
+                positions.append(position)
+                value = shift = 0
+        return positions
+
+    def find(self, docno, lo = 0):
+        """Index of docno's posting (searching from lo), or None."""
+        i = bisect_left(self.docnos, docno, lo)
+        return i if i < len(self.docnos) and self.docnos[i] == docno else None
+
+    def __len__(self):
+        return len(self.docnos)
+
+    @staticmethod
+    def encode_varint(value, out):
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+class InvertedIndex(object):
+    """In-memory term -> postings index over the title and descr of every episode.
+
+    Documents are numbered densely in insertion order (docno); the original
+    row is kept so results can be served without going back to MySQL, along
+    with the character offsets of its tokens (token_offsets()) so snippets
+    and highlights are cut without tokenizing it again.
+
+    Updates are incremental: add() of an existing id tombstones the old docno
+    and appends the new version, delete() tombstones. Tombstoned documents stay
+    in the postings (skipped by every reader) and are subtracted
+    from df() and the length statistics until compacted() drops them.
+    """
+
+    FIELDS = ("title", "descr")
+    # Positions run through the title, then the description after this gap, so phrases never span the two
+    FIELD_GAP = 16
+    PHRASE = re.compile(r'"([^"]*)(?:"|$)')
+    # a NEAR/k b, possibly chained (a NEAR/2 b NEAR/3 c: b is the right operand of one pair and the left of the next)
+    NEAR = re.compile(r"(\S+)((?:\s+NEAR/\d+\s+\S+)+)")
+    NEAR_STEP = re.compile(r"NEAR/(\d+)\s+(\S+)")
+    # Operators and grouping of a BooleanQuery
+    BOOLEAN = re.compile(r"\b(?:AND|OR|NOT)\b|[()]")
+
+    def __init__(self, tokenizer = None):
+        self.tokenizer = tokenizer or Tokenizer()
+        self.postings = {}
+        self.rows = []
+        self.docnos = {}
+        self.field_lengths = tuple([] for _ in InvertedIndex.FIELDS)
+        self.offsets = []
+        self.deleted = set()
+        self.dead_df = {}
+        self.version = 0
+        self._vocabulary = None
+
+    @classmethod
+    def build(cls, rows, tokenizer = None):
+        index = cls(tokenizer)
+        for row in rows:
+            index.add(row)
+        return index
+
+    def add(self, row):
+        doc_id, title, descr = row[0], row[1] or "", row[2] or ""
+        if doc_id in self.docnos:
+            self.delete(doc_id)
+        docno = len(self.rows)
+        self.rows.append((doc_id, title, descr))
+        self.docnos[doc_id] = docno
+        field_spans = [self.tokenizer.spans(title), self.tokenizer.spans(descr)]
+        field_terms = [[term for term, _, _ in spans] for spans in field_spans]
+        self.offsets.append(array("I", (offset for spans in field_spans for _, start, end in spans for offset in (start, end))))
+        field_counts = [Counter(terms) for terms in field_terms]
+        positions = {}
+        offset = 0
+        for lengths, terms in zip(self.field_lengths, field_terms):
+            lengths.append(len(terms))
+            for position, term in enumerate(terms, offset):
+                positions.setdefault(term, []).append(position)
+            offset += len(terms) + InvertedIndex.FIELD_GAP
+        for term, term_positions in positions.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = Postings(len(InvertedIndex.FIELDS))
+            postings.append(docno, [counts[term] for counts in field_counts], term_positions)
+        self._vocabulary = None
+        self.version += 1
+        return docno
+
+    def delete(self, doc_id):
+        docno = self.docnos.pop(doc_id, None)
+        if docno is None:
+            return None
+        self.deleted.add(docno)
+        _, title, descr = self.rows[docno]
+        for term in set(self.tokenizer.tokenize(title)).union(self.tokenizer.tokenize(descr)):
+            self.dead_df[term] = self.dead_df.get(term, 0) + 1
+        self.version += 1
+        return docno
+
+    def df(self, term):
+        postings = self.postings.get(term)
+        return 0 if postings is None else len(postings) - self.dead_df.get(term, 0)
+
+    def document_frequencies(self):
+        """{term: number of postings} for every term, tombstoned documents included."""
+        return {term: len(postings) for term, postings in self.postings.items()}
+
+    def live_count(self):
+        return len(self.rows) - len(self.deleted)
+
+    def live_docnos(self):
+        return (docno for docno in range(len(self.rows)) if docno not in self.deleted)
+
+    def compacted(self):
+        """Returns a new index without tombstoned documents, renumbered densely, built from the existing postings."""
+        index = InvertedIndex(self.tokenizer)
+        renumber = {}
+        for docno in self.live_docnos():
+            renumber[docno] = len(index.rows)
+            index.rows.append(self.rows[docno])
+            index.docnos[self.rows[docno][0]] = renumber[docno]
+            for lengths, old_lengths in zip(index.field_lengths, self.field_lengths):
+                lengths.append(old_lengths[docno])
+            index.offsets.append(self.token_offsets(docno))
+        for term, postings in self.postings.items():
+            compact = None
+            for i, docno in enumerate(postings.docnos):
+                if docno in renumber:
+                    if compact is None:
+                        compact = index.postings[term] = Postings(len(InvertedIndex.FIELDS))
+                    compact.append(renumber[docno], [field_tfs[i] for field_tfs in postings.field_tfs], postings.positions_at(i))
+        return index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def token_offsets(self, docno):
+        """Character offsets of the document's tokens, flattened as start, end pairs: the title's, then the description's.
+
+        Token t of the description is at position field_lengths[0][docno] + FIELD_GAP + t in the postings.
+        """
+        return self.offsets[docno]
+
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        return self._vocabulary
+
+    def terms_with_prefix(self, prefix):
+        vocabulary = self.vocabulary()
+        terms = []
+        for i in range(bisect_left(vocabulary, prefix), len(vocabulary)):
+            if not vocabulary[i].startswith(prefix):
+                break
+            terms.append(vocabulary[i])
+        return terms
+
+    def result(self, docno, **extra):
+        doc_id, title, descr = self.rows[docno]
+        return dict({"id": doc_id, "title": title, "descr": descr}, **extra)
+
+    def search(self, query, limit = 10):
+        """Conjunctive term search ranked by summed term frequency.
+
+        Every query term must occur in the title or description. Unless the
+        query ends in whitespace the last term is still being typed, so it
+        matches any term it is a prefix of. "Quoted phrases" must occur as
+        written and `a NEAR/k b` needs a and b at most k terms apart.
+        """
+        if not self.tokenizer.tokenize(query):
+            return [self.result(docno) for docno, _ in zip(self.live_docnos(), range(limit))]
+        return self.top(self.matches(query), limit)
+
+    def top(self, scores, limit = 10):
+        top = heapq.nsmallest(limit, scores.items(), key = lambda item: (-item[1], item[0]))
+        return [self.result(docno) for docno, _ in top]
+
+    @staticmethod
+    def is_structured(query):
+        """True if query has phrase, proximity or boolean syntax, which normalizing it to its terms would lose."""
+        return '"' in query or InvertedIndex.NEAR.search(query) is not None or InvertedIndex.BOOLEAN.search(query) is not None
+
+    def query_key(self, query):
+        """Normalized query; the matches of a query whose key extends another's are a subset of the other's.
+
+        Empty for structured queries, which are not normalized.
+        """
+        if InvertedIndex.is_structured(query):
+            return ""
+        terms = self.tokenizer.tokenize(query)
+        return " ".join(terms) + (" " if terms and query[-1:].isspace() else "")
+
+    def parse_clauses(self, query):
+        """Splits the phrases and NEAR/k pairs off query: ([(terms, k)], rest), k None for a phrase.
+
+        A chain a NEAR/2 b NEAR/3 c becomes the pairs (a, b) and (b, c).
+        """
+        clauses = []
+        def near(match):
+            left = self.tokenizer.tokenize(match.group(1))
+            for k, operand in InvertedIndex.NEAR_STEP.findall(match.group(2)):
+                right = self.tokenizer.tokenize(operand)
+                if left and right:
+                    clauses.append(([left[-1], right[0]], int(k)))
+                left = right
+            return " "
+        def phrase(match):
+            clauses.append((self.tokenizer.tokenize(match.group(1)), None))
+            return " "
+        rest = InvertedIndex.NEAR.sub(near, InvertedIndex.PHRASE.sub(phrase, query))
+        return [clause for clause in clauses if clause[0]], rest
+
+    def matches(self, query, candidates = None):
+        """Scores (docno -> summed term frequency) of every document search() would match, among candidates if given."""
+        clauses, query = self.parse_clauses(query)
+        terms = self.tokenizer.tokenize(query)
+        partial = None if query[-1:].isspace() or not terms else terms.pop()
+        matches = [self._term_scores([term], candidates) for term in terms]
+        if partial is not None:
+            matches.append(self._term_scores(self.terms_with_prefix(partial), candidates))
+        for clause_terms, k in clauses:
+            docnos = self.phrase_docnos(clause_terms, candidates) if k is None else self.near_docnos(clause_terms[0], clause_terms[1], k, candidates)
+            matches.append(self._term_scores(set(clause_terms), set(docnos)))
+        if not matches:
+            return {}
+        matches.sort(key = len)
+        scores = matches[0]
+        for other in matches[1:]:
+            scores = {docno: score + other[docno] for docno, score in scores.items() if docno in other}
+            if not scores:
+                break
+        return scores
+
+    def intersect(self, terms, candidates = None):
+        """Docnos (ascending) in the postings of every term, walking the postings rarest term first."""
+        lists = []
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if postings is None:
+                return []
+            lists.append(postings)
+        lists.sort(key = len)
+        docnos = [docno for docno in lists[0].docnos if docno not in self.deleted and (candidates is None or docno in candidates)]
+        for postings in lists[1:]:
+            kept = []
+            lo = 0
+            for docno in docnos:
+                i = postings.find(docno, lo)
+                if i is not None:
+                    kept.append(docno)
+                    lo = i + 1
+            docnos = kept
+            if not docnos:
+                break
+        return docnos
+
+    def positions(self, term, docno):
+        postings = self.postings.get(term)
+        i = None if postings is None else postings.find(docno)
+        return [] if i is None else postings.positions_at(i)
+
+    def phrase_docnos(self, terms, candidates = None):
+        """Docnos (ascending) containing terms consecutively; positions are only read for documents holding every term."""
+        matched = []
+        for docno in self.intersect(terms, candidates):
+            starts = self.positions(terms[0], docno)
+            following = [set(self.positions(term, docno)) for term in terms[1:]]
+            if any(all(start + offset in positions for offset, positions in enumerate(following, 1)) for start in starts):
+                matched.append(docno)
+        return matched
+
+    def near_docnos(self, a, b, k, candidates = None):
+        """Docnos (ascending) in which a and b occur at most k positions apart, in either order."""
+        return [docno for docno in self.intersect([a, b], candidates)
+                if InvertedIndex.min_distance(self.positions(a, docno), self.positions(b, docno)) <= k]
+
+    @staticmethod
+    def min_distance(a, b):
+        """Smallest |x - y| for x in a and y in b (both ascending), by merging them; None if either is empty."""
+        if not a or not b:
+            return None
+        i = j = 0
+        best = None
+        while i < len(a) and j < len(b):
+            distance = abs(a[i] - b[j])
+            if best is None or distance < best:
+                best = distance
+            if a[i] < b[j]:
+                i += 1
+            else:
+                j += 1
+        return best
+
+    def _term_scores(self, terms, candidates = None):
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            if candidates is None:
+                for docno, tf in zip(postings.docnos, postings.tfs):
+                    scores[docno] = scores.get(docno, 0) + tf
+            elif len(candidates) * 8 < len(postings):
+                # Few candidates against long postings: binary-search each candidate
+                for docno in candidates:
+                    i = bisect_left(postings.docnos, docno)
+                    if i < len(postings.docnos) and postings.docnos[i] == docno:
+                        scores[docno] = scores.get(docno, 0) + postings.tfs[i]
+            else:
+                for docno, tf in zip(postings.docnos, postings.tfs):
+                    if docno in candidates:
+                        scores[docno] = scores.get(docno, 0) + tf
+        for docno in self.deleted.intersection(scores):
+            del scores[docno]
+        return scores
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+
+class IvfIndex(object):
+    """Inverted-file approximate nearest-neighbor index over L2-normalized embeddings.
+
+    Spherical k-means splits the embeddings into n_lists clusters; each
+    cluster's rows are stored contiguously (order/offsets). A search scores
+    the query against the centroids, takes the nprobe closest lists and
+    computes exact dot products only for the rows in those lists, so the work
+    per query is roughly nprobe / n_lists of a brute-force scan. Raising
+    nprobe trades latency for recall; nprobe = n_lists is exact. Rows
+    written after clustering (add()) are scored by every search until the
+    index is rebuilt.
+    """
+
+    CHUNK = 1 << 15
+
+    def __init__(self, centroids, order, offsets, nprobe = None):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe or max(1, min(len(centroids), 8))
+        self.pending = np.empty(0, dtype = np.int64)
+
+    @classmethod
+    def build(cls, embeddings, n_lists, iterations = 10, sample = 256, seed = 0):
+        """Clusters embeddings (rows L2-normalized) into n_lists lists, training k-means on at most sample rows per list."""
+        rng = np.random.RandomState(seed)
+        n_lists = max(1, min(n_lists, len(embeddings)))
+        training = embeddings
+        if len(embeddings) > n_lists * sample:
+            training = embeddings[np.sort(rng.choice(len(embeddings), n_lists * sample, replace = False))]
+        training = np.asarray(training, dtype = np.float32)
+        centroids = training[rng.choice(len(training), n_lists, replace = False)].copy()
+        for _ in range(iterations):
+            assignment = IvfIndex.assign(training, centroids)
+            order = np.argsort(assignment, kind = "stable")
+            counts = np.bincount(assignment, minlength = n_lists)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            filled = counts > 0
+            sums = np.add.reduceat(training[order], starts[filled], axis = 0)
+            centroids[filled] = sums
+            # Empty lists are re-seeded from random training rows
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = training[rng.choice(len(training), len(empty), replace = False)]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis = 1, keepdims = True), 1e-12)
+        assignment = IvfIndex.assign(embeddings, centroids)
+        order = np.argsort(assignment, kind = "stable").astype(np.int32)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength = n_lists)))).astype(np.int64)
+        return cls(centroids, order, offsets)
+
+    @staticmethod
+    def assign(embeddings, centroids):
+        """Index of the closest centroid (largest dot product) for every row, computed in chunks."""
+        assignment = np.empty(len(embeddings), dtype = np.int64)
+        for start in range(0, len(embeddings), IvfIndex.CHUNK):
+            block = np.asarray(embeddings[start:start + IvfIndex.CHUNK], dtype = np.float32)
+            assignment[start:start + len(block)] = np.argmax(block.dot(centroids.T), axis = 1)
+        return assignment
+
+    def candidates(self, vector, nprobe = None):
+        """Row numbers in the nprobe lists whose centroids are closest to vector."""
+        nprobe = int(max(1, min(nprobe or self.nprobe, len(self.centroids))))
+        scores = self.centroids.dot(vector)
+        lists = np.argpartition(-scores, nprobe - 1)[:nprobe] if nprobe < len(scores) else np.arange(len(scores))
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists] + [self.pending])
+
+    def add(self, rows):
+        self.pending = np.union1d(self.pending, rows).astype(np.int64)
+
+    def search(self, embeddings, vector, nprobe = None):
+        """(rows, scores) for every row in the probed lists; the caller takes the top k."""
+        # Sorted (and rows also pending only once), so the gather reads a memory-mapped matrix front to back
+        rows = np.unique(self.candidates(vector, nprobe))
+        return rows, np.asarray(embeddings[rows], dtype = np.float32).dot(vector)
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as ivf_file:
+            np.savez(ivf_file, centroids = self.centroids, order = self.order, offsets = self.offsets, nprobe = self.nprobe)
+            size = ivf_file.tell()
+        os.replace(path + ".tmp", path)
+        return size
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays["centroids"], arrays["order"], arrays["offsets"], int(arrays["nprobe"]))
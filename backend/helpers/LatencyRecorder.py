@@ -0,0 +1,41 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class LatencyRecorder(object):
+    """Keeps the most recent request latencies per search path and reports percentiles."""
+
+    def __init__(self, window = 10000):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, path):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(path, time.perf_counter() - started)
+
+    def record(self, path, seconds):
+        with self.lock:
+            if path not in self.samples:
+                self.samples[path] = deque(maxlen = self.window)
+            self.samples[path].append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            samples = {path: sorted(values) for path, values in self.samples.items()}
+        return {path: {
+                    "count": len(values),
+                    "p50_ms": round(LatencyRecorder.percentile(values, 50) * 1000, 3),
+                    "p99_ms": round(LatencyRecorder.percentile(values, 99) * 1000, 3),
+                } for path, values in samples.items()}
+
+    @staticmethod
+    def percentile(values, pct):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
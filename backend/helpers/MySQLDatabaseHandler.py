@@ -1,47 +1,339 @@
+import hashlib
 import os
+import time
+from contextlib import contextmanager
 import sqlalchemy as db
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from helpers.PoolStats import PoolStats
+from helpers.SQLFileReader import SQLFileReader
 
 class MySQLDatabaseHandler(object):
     
     IS_DOCKER = True if 'DB_NAME' in os.environ else False
+    FINGERPRINT_TABLE = "load_fingerprints"
+    FILE_KEY = "*"
 
-    def __init__(self,MYSQL_USER,MYSQL_USER_PASSWORD,MYSQL_PORT,MYSQL_DATABASE,MYSQL_HOST = "localhost"):
+    def __init__(self,MYSQL_USER,MYSQL_USER_PASSWORD,MYSQL_PORT,MYSQL_DATABASE,MYSQL_HOST = "localhost",
+                 pool_size = 5,max_overflow = 10,pool_pre_ping = True,pool_recycle = 3600,pool_timeout = 30):
         
         self.MYSQL_HOST = os.environ['DB_NAME'] if MySQLDatabaseHandler.IS_DOCKER else MYSQL_HOST
         self.MYSQL_USER = "admin" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_USER
         self.MYSQL_USER_PASSWORD = "admin" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_USER_PASSWORD
         self.MYSQL_PORT = 3306 if MySQLDatabaseHandler.IS_DOCKER else MYSQL_PORT
         self.MYSQL_DATABASE = "kardashiandb" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_DATABASE
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_pre_ping = pool_pre_ping
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
         self.engine = self.validate_connection()
+        self.stats = PoolStats(self.engine.pool, self.max_overflow)
+        self.statements = {}
+        self.compile_stats = {"cache_hits": 0, "compiled": 0, "uncached": 0, "raw": 0}
+        db.event.listen(self.engine, "before_cursor_execute", self._count_compilation)
+        self.watchers = {}
+        self.key_types = {}
 
     def validate_connection(self):
         print(f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}")
-        return db.create_engine(f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}")
+        return db.create_engine(f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}",
+                                pool_size = self.pool_size,max_overflow = self.max_overflow,pool_pre_ping = self.pool_pre_ping,
+                                pool_recycle = self.pool_recycle,pool_timeout = self.pool_timeout)
 
     def lease_connection(self):
-        return self.engine.connect()
+        # The caller owns the returned connection and must close() it; prefer connection()/transaction()
+        with self.stats.timed_checkout():
+            return self.engine.connect()
+
+    @contextmanager
+    def connection(self):
+        conn = self.lease_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            with conn.begin():
+                yield conn
+
+    def pool_stats(self):
+        return self.stats.snapshot()
+
+    def prepared(self,sql):
+        # One text() construct per query shape, so SQLAlchemy compiles it once and serves it from its compiled cache
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements.setdefault(sql, db.text(sql))
+        return statement
+
+    def statement_stats(self):
+        return dict(self.compile_stats)
+
+    def _count_compilation(self,conn,cursor,statement,parameters,context,executemany):
+        if context is None or context.compiled is None:
+            self.compile_stats["raw"] += 1
+        elif context.cache_hit is CACHE_HIT:
+            self.compile_stats["cache_hits"] += 1
+        elif context.cache_hit is CACHE_MISS:
+            self.compile_stats["compiled"] += 1
+        else:
+            self.compile_stats["uncached"] += 1
+
+    @staticmethod
+    def escape_like(value):
+        return value.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")
     
     def query_executor(self,query):
-        conn = self.lease_connection()
-        if type(query) == list:
-            for i in query:
+        # Writes to watched tables are followed by a change notification once the transaction commits
+        affected = {}
+        with self.transaction() as conn:
+            for i in (query if type(query) == list else [query]):
+                table, keys = self._affected_keys(conn,i)
                 conn.execute(i)
-        else:
-            conn.execute(query)
-        
+                if table is not None:
+                    if keys is None or affected.get(table, ()) is None:
+                        affected[table] = None
+                    else:
+                        affected.setdefault(table, set()).update(keys)
+        for table, keys in affected.items():
+            self._publish(table,keys)
 
-    def query_selector(self,query):
-        conn = self.lease_connection()
-        data = conn.execute(query)
-        return data
+    def watch(self,table,listener,key = "id",columns = ("id","title","descr")):
+        """Calls listener(table, changes) after every query_executor write to table.
+
+        changes lists ("upsert", key, row) for rows inserted or updated and ("delete", key, None)
+        for rows removed, with row holding the given columns. It is None when the written rows
+        cannot be determined from the statement (e.g. TRUNCATE, INSERT ... SELECT, SQLAlchemy
+        constructs) and the listener should resynchronize the whole table.
+        """
+        self.watchers.setdefault(table.lower(), []).append((listener, key, tuple(columns)))
+
+    def _affected_keys(self,conn,query):
+        # Returns (table, keys) for a statement writing a watched table, (None, None) otherwise;
+        # keys is None when they cannot be worked out. Must run before the statement executes.
+        sql = query if isinstance(query,str) else str(query)
+        table = SQLFileReader.statement_table(sql)
+        if table not in self.watchers:
+            return None, None
+        if not isinstance(query,str):
+            return table, None
+        key = self.watchers[table][0][1]
+        insert = SQLFileReader.parse_insert(sql)
+        if insert is not None:
+            columns = SQLFileReader.INSERT_HEAD.match(sql).group(2)
+            columns = [i.strip(" `") for i in columns.strip("()").split(",")] if columns else [i["name"] for i in db.inspect(self.engine).get_columns(table)]
+            try:
+                position = columns.index(key)
+                key_type = self._key_type(table,key)
+                return table, [key_type(SQLFileReader.literal(row[position])) for row in SQLFileReader.row_values(insert[1])]
+            except (ValueError, IndexError, TypeError):
+                return table, None
+        where = SQLFileReader.write_filter(sql)
+        if where is None:
+            return table, None
+        # An UPDATE that moves rows to new keys writes keys the WHERE clause cannot see
+        if key.lower() in (SQLFileReader.assigned_columns(sql) or ()):
+            return table, None
+        # Over-approximates the written rows when the write also has ORDER BY/LIMIT; re-reading extra rows is harmless
+        return table, [row[0] for row in conn.execute(f"SELECT {key} FROM {table} {where} FOR UPDATE")]
 
-    def load_file_into_db(self,file_path  = None):
+    def _key_type(self,table,key):
+        # Python type of the key column, so quoted literals ('5') match the keys rows come back with
+        if (table, key) not in self.key_types:
+            column = [i for i in db.inspect(self.engine).get_columns(table) if i["name"].lower() == key.lower()]
+            try:
+                self.key_types[(table, key)] = column[0]["type"].python_type
+            except (IndexError, NotImplementedError):
+                self.key_types[(table, key)] = lambda value: value
+        return self.key_types[(table, key)]
+
+    def _publish(self,table,keys):
+        published = {}
+        for listener, key, columns in self.watchers[table]:
+            changes = published.get((key, columns))
+            if changes is None and keys is not None:
+                rows = {}
+                if keys:
+                    statement = db.text(f"SELECT {', '.join(columns)} FROM {table} WHERE {key} IN :keys").bindparams(db.bindparam("keys", expanding = True))
+                    rows = {row[columns.index(key)]: tuple(row) for row in self.query_selector(statement, {"keys": sorted(keys)})}
+                changes = published[(key, columns)] = [("upsert", i, rows[i]) if i in rows else ("delete", i, None) for i in sorted(keys)]
+            try:
+                listener(table,changes)
+            except Exception as e:
+                print(f"Change listener for {table} failed: {e}")
+
+    def query_selector(self,query,params = None):
+        # Rows are fetched before the connection goes back to the pool
+        with self.connection() as conn:
+            if params is None:
+                return conn.execute(query).fetchall()
+            return conn.execute(query,params).fetchall()
+
+    def query_streamer(self,query,params = None,batch_size = 1000):
+        # Generator over lists of at most batch_size rows, read through an unbuffered server-side
+        # cursor so only one batch is held in memory. The connection goes back to the pool when the
+        # generator is exhausted or closed early (closing drains the rest of the result set).
+        if isinstance(query,str):
+            query = db.text(query)
+        with self.connection() as conn:
+            result = conn.execution_options(stream_results = True,max_row_buffer = batch_size).execute(query,params or {})
+            try:
+                while True:
+                    batch = result.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    yield batch
+            finally:
+                result.close()
+
+    def table_checksum(self,table):
+        # Live checksum of the table's contents; changes whenever any row does
+        with self.connection() as conn:
+            row = conn.exec_driver_sql(f"CHECKSUM TABLE {table}").fetchone()
+        return row[1] if row is not None and row[1] is not None else 0
+
+    def ensure_schema(self,table,columns = None,indexes = None):
+        # Applies the DDL for any listed column/index the table does not have yet, so databases
+        # created from an older init.sql (e.g. the deployed one, which is only initialized once) catch up
+        inspector = db.inspect(self.engine)
+        if not inspector.has_table(table):
+            return
+        present_columns = set(column["name"] for column in inspector.get_columns(table))
+        present_indexes = set(index["name"] for index in inspector.get_indexes(table))
+        if inspector.get_pk_constraint(table).get("constrained_columns"):
+            present_indexes.add("PRIMARY")
+        pending = [ddl for name, ddl in (columns or {}).items() if name not in present_columns]
+        pending += [ddl for name, ddl in (indexes or {}).items() if name not in present_indexes]
+        for ddl in pending:
+            try:
+                with self.transaction() as conn:
+                    conn.execute(db.text(ddl))
+                print(f"Schema upgrade applied: {ddl}")
+            except db.exc.DBAPIError as e:
+                print(f"Schema upgrade failed: {ddl} ({e.orig})")
+
+    def load_file_into_db(self,file_path  = None,force = False,batch_rows = 1000,batch_bytes = 1 << 20,commit_rows = 20000):
         if MySQLDatabaseHandler.IS_DOCKER:
             return
         if file_path is None:
             file_path = os.path.join(os.environ['ROOT_PATH'],'init.sql')
-        sql_file = open(file_path,"r")
-        sql_file_data = list(filter(lambda x:x != '',sql_file.read().split(";\n")))
-        self.query_executor(sql_file_data)
-        sql_file.close()
+        source = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        stored = {} if force else self.stored_fingerprints(source)
+        existing = set(name.lower() for name in db.inspect(self.engine).get_table_names())
+        tables_present = all(table in existing for table in stored if table != MySQLDatabaseHandler.FILE_KEY)
+        file_print = stored.get(MySQLDatabaseHandler.FILE_KEY)
+        if file_print is not None and tables_present and file_print[1:] == (stat.st_size, stat.st_mtime):
+            print(f"{file_path} unchanged since last load, skipping")
+            return 0
+        file_hash = self.file_hash(file_path)
+        if file_print is not None and tables_present and file_print[0] == file_hash:
+            print(f"{file_path} content unchanged since last load, skipping")
+            self.save_fingerprints(source, {MySQLDatabaseHandler.FILE_KEY: file_hash}, stat)
+            return 0
+        if stored:
+            table_hashes = self.table_hashes(SQLFileReader(file_path).statements())
+            changed = set(table for table, digest in table_hashes.items() if stored.get(table, (None,))[0] != digest or table not in existing)
+            print(f"Reloading changed tables from {file_path}: {', '.join(sorted(changed)) or '(none)'}")
+            # Statements that target no table (SET, USE, ...) are session setup and always replayed
+            statements = (i for i in SQLFileReader(file_path).statements() if SQLFileReader.statement_table(i) in changed or SQLFileReader.statement_table(i) is None)
+        else:
+            table_hashes = {}
+            statements = self._hashing(SQLFileReader(file_path).statements(), table_hashes)
+        rows = self.load_statements(statements, batch_rows, batch_bytes, commit_rows, file_path)
+        table_hashes[MySQLDatabaseHandler.FILE_KEY] = file_hash
+        self.save_fingerprints(source, table_hashes, stat)
+        return rows
+
+    def load_statements(self,statements,batch_rows = 1000,batch_bytes = 1 << 20,commit_rows = 20000,label = "statements"):
+        started = time.perf_counter()
+        rows = 0
+        with self.connection() as conn:
+            trans = conn.begin()
+            # Consecutive single-row INSERTs into the same table are folded into one multi-row INSERT
+            pending_head, pending_values, pending_rows, pending_bytes = None, [], 0, 0
+            uncommitted = 0
+            for statement in statements:
+                insert = SQLFileReader.parse_insert(statement)
+                if insert is not None and insert[0] == pending_head and pending_rows < batch_rows and pending_bytes + len(insert[1]) < batch_bytes:
+                    pending_values.append(insert[1])
+                    pending_rows += insert[2]
+                    pending_bytes += len(insert[1])
+                    continue
+                if pending_head is not None:
+                    self._execute_raw(conn, f"{pending_head} VALUES {','.join(pending_values)}")
+                    rows += pending_rows
+                    uncommitted += pending_rows
+                    pending_head, pending_values, pending_rows, pending_bytes = None, [], 0, 0
+                if uncommitted >= commit_rows:
+                    trans.commit()
+                    trans = conn.begin()
+                    uncommitted = 0
+                if insert is not None:
+                    pending_head, pending_values, pending_rows, pending_bytes = insert[0], [insert[1]], insert[2], len(insert[1])
+                else:
+                    self._execute_raw(conn, statement)
+            if pending_head is not None:
+                self._execute_raw(conn, f"{pending_head} VALUES {','.join(pending_values)}")
+                rows += pending_rows
+            trans.commit()
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        print(f"Loaded {rows} rows from {label} in {elapsed:.2f}s ({rows / elapsed:.0f} rows/sec)")
+        return rows
+
+    def file_hash(self,file_path,chunk_size = 1 << 20):
+        digest = hashlib.sha256()
+        with open(file_path,"rb") as sql_file:
+            for chunk in iter(lambda: sql_file.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def table_hashes(self,statements):
+        hashes = {}
+        for statement in self._hashing(statements, hashes):
+            pass
+        return hashes
+
+    def _hashing(self,statements,hashes):
+        # Passes statements through while folding each one into the digest of the table it targets
+        digests = {}
+        for statement in statements:
+            table = SQLFileReader.statement_table(statement)
+            if table is not None:
+                if table not in digests:
+                    digests[table] = hashlib.sha256()
+                digests[table].update(statement.encode("utf-8"))
+                digests[table].update(b"\0")
+                hashes[table] = digests[table].hexdigest()
+            yield statement
+
+    def stored_fingerprints(self,source):
+        self._ensure_fingerprint_table()
+        with self.connection() as conn:
+            result = conn.execute(db.text(f"SELECT table_name, sha256, size, mtime FROM {MySQLDatabaseHandler.FINGERPRINT_TABLE} WHERE source = :source"), {"source": source})
+            return {row[0]: (row[1], row[2], row[3]) for row in result}
+
+    def save_fingerprints(self,source,hashes,stat):
+        self._ensure_fingerprint_table()
+        with self.transaction() as conn:
+            for table, digest in hashes.items():
+                conn.execute(db.text(f"REPLACE INTO {MySQLDatabaseHandler.FINGERPRINT_TABLE} (source, table_name, sha256, size, mtime) VALUES (:source, :table_name, :sha256, :size, :mtime)"),
+                    {"source": source, "table_name": table, "sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime})
+
+    def _ensure_fingerprint_table(self):
+        with self.transaction() as conn:
+            conn.execute(db.text(f"""CREATE TABLE IF NOT EXISTS {MySQLDatabaseHandler.FINGERPRINT_TABLE} (
+                source varchar(255) NOT NULL,
+                table_name varchar(64) NOT NULL,
+                sha256 char(64) NOT NULL,
+                size bigint NOT NULL,
+                mtime double NOT NULL,
+                loaded_at timestamp DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (source, table_name))"""))
 
+    def _execute_raw(self,conn,statement):
+        # The statement goes to pymysql untouched, so literal % signs must be escaped for its format paramstyle
+        conn.exec_driver_sql(statement.replace("%","%%"))
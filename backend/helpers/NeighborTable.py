@@ -0,0 +1,114 @@
+import os
+import numpy as np
+
+class NeighborTable(object):
+    """Precomputed "more like this" lists: the k most similar documents of every document.
+
+    Row i holds the ids (int32) and cosine similarities (float16) of the
+    nearest neighbors of SemanticIndex row i, best first, padded with id -1.
+    Similarities are computed a block of rows at a time against the whole
+    embedding matrix, with the block sized so it stays under BLOCK_BYTES, so
+    the N x N similarity matrix never exists. update() recomputes only the
+    rows a write can affect: the written rows, rows that listed one of them,
+    and rows whose k-th neighbor a written row now beats.
+    """
+
+    BLOCK_BYTES = 64 << 20
+
+    def __init__(self, neighbors, scores):
+        self.neighbors = neighbors
+        self.scores = scores
+
+    @property
+    def k(self):
+        return self.neighbors.shape[1]
+
+    @classmethod
+    def build(cls, semantic, k = 10, live = None):
+        n = len(semantic.ids)
+        table = cls(np.full((n, k), -1, dtype = np.int32), np.zeros((n, k), dtype = np.float16))
+        table.compute(semantic, np.arange(n), live)
+        return table
+
+    def compute(self, semantic, rows, live = None):
+        """(Re)computes the neighbor lists of rows."""
+        docs = semantic.docs
+        ids = np.asarray(semantic.ids)
+        if np.any(ids > np.iinfo(np.int32).max):
+            raise ValueError("neighbor tables store ids as int32")
+        k = min(self.k, len(ids) - 1)
+        if k <= 0:
+            return
+        block = self._block(len(ids))
+        for start in range(0, len(rows), block):
+            chunk = rows[start:start + block]
+            similarities = np.asarray(docs[chunk], dtype = np.float32).dot(np.asarray(docs, dtype = np.float32).T)
+            if live is not None:
+                similarities[:, ~live] = -np.inf
+            similarities[np.arange(len(chunk)), chunk] = -np.inf
+            top = np.argpartition(-similarities, k - 1, axis = 1)[:, :k]
+            top_scores = np.take_along_axis(similarities, top, axis = 1)
+            best = np.argsort(-top_scores, axis = 1, kind = "stable")
+            top = np.take_along_axis(top, best, axis = 1)
+            top_scores = np.take_along_axis(top_scores, best, axis = 1)
+            found = np.isfinite(top_scores)
+            self.neighbors[chunk] = -1
+            self.scores[chunk] = 0
+            self.neighbors[chunk, :k] = np.where(found, ids[top], -1)
+            self.scores[chunk, :k] = np.where(found, top_scores, 0)
+
+    def _block(self, n):
+        # Rows per block so that a block x n float32 similarity matrix stays under BLOCK_BYTES
+        return max(1, min(1024, NeighborTable.BLOCK_BYTES // (4 * n)))
+
+    def update(self, semantic, changed, live = None):
+        """Brings the table up to date after semantic.apply() changed the embedding rows in changed."""
+        if not self.neighbors.flags.writeable:
+            self.neighbors, self.scores = np.array(self.neighbors), np.array(self.scores)
+        added = len(semantic.ids) - len(self.neighbors)
+        if added > 0:
+            self.neighbors = np.concatenate([self.neighbors, np.full((added, self.k), -1, dtype = np.int32)])
+            self.scores = np.concatenate([self.scores, np.zeros((added, self.k), dtype = np.float16)])
+        if not len(changed):
+            return 0
+        stale = np.isin(self.neighbors, np.asarray(semantic.ids)[changed]).any(axis = 1)
+        written = changed if live is None else changed[live[changed]]
+        if len(written):
+            # Rows for which a written document now scores above their current k-th neighbor. The stored
+            # float16 score may have been rounded up by up to half an ulp, so compare against its lower bound.
+            kth = self.scores[:, -1]
+            lower = kth.astype(np.float32) - np.abs(np.spacing(kth)).astype(np.float32) / 2
+            threshold = np.where(self.neighbors[:, -1] >= 0, lower, -np.inf)
+            block = self._block(len(semantic.ids))
+            for start in range(0, len(written), block):
+                similarities = np.asarray(semantic.docs, dtype = np.float32).dot(np.asarray(semantic.docs[written[start:start + block]], dtype = np.float32).T)
+                stale |= (similarities > threshold[:, None]).any(axis = 1)
+        stale[changed] = True
+        if live is not None:
+            stale &= live
+        rows = np.flatnonzero(stale)
+        self.compute(semantic, rows, live)
+        return len(rows)
+
+    def similar(self, row, limit = None):
+        """[(id, score)] of the neighbors of a SemanticIndex row, best first."""
+        return [(int(doc_id), float(score)) for doc_id, score in zip(self.neighbors[row][:limit], self.scores[row][:limit]) if doc_id >= 0]
+
+    def save(self, path):
+        size = 0
+        for suffix, array in ((".similar.ids.npy", self.neighbors), (".similar.scores.npy", self.scores)):
+            with open(path + suffix + ".tmp", "wb") as array_file:
+                np.save(array_file, array)
+                size += array_file.tell()
+            os.replace(path + suffix + ".tmp", path + suffix)
+        return size
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path + ".similar.ids.npy", mmap_mode = "r"), np.load(path + ".similar.scores.npy", mmap_mode = "r"))
+
+    @staticmethod
+    def remove(path):
+        for suffix in (".similar.ids.npy", ".similar.scores.npy"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
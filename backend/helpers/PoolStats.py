@@ -0,0 +1,55 @@
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+class PoolStats(object):
+    """Counters for connection checkouts against a SQLAlchemy QueuePool.
+
+    A checkout counts as a wait when it starts while every pooled and overflow
+    connection is already leased, i.e. the caller has to block for a checkin.
+    """
+
+    def __init__(self, pool, max_overflow):
+        self.pool = pool
+        self.max_overflow = max_overflow
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @contextmanager
+    def timed_checkout(self):
+        saturated = self.pool.checkedout() >= self.pool.size() + self.max_overflow
+        started = time.perf_counter()
+        try:
+            yield
+        except PoolTimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+            if saturated:
+                self.waits += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "size": self.pool.size(),
+                "max_overflow": self.max_overflow,
+                "checked_in": self.pool.checkedin(),
+                "checked_out": self.pool.checkedout(),
+                "overflow": max(self.pool.overflow(), 0),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "wait_time_total": round(self.wait_time, 6),
+                "wait_time_avg": round(self.wait_time / self.checkouts, 6) if self.checkouts else 0.0,
+                "wait_time_max": round(self.max_wait_time, 6),
+            }
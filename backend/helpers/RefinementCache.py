@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+class RefinementCache(object):
+    """Complete match sets of recent queries, for answering queries that extend them.
+
+    Keys are normalized query strings, per search mode, chosen so that a key
+    extending a cached key can only match a subset of the cached matches:
+    "kim b" -> "kim bi" only narrows what matched before. lookup() returns the
+    longest cached prefix of a key, and the caller filters its matches instead
+    of searching the whole corpus. Match sets larger than max_candidates are
+    not kept, since filtering them is no cheaper than a fresh search.
+
+    Not thread-safe; SearchEngine only uses it under its lock.
+    """
+
+    def __init__(self, max_entries = 256, max_candidates = 1000):
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.entries = OrderedDict()
+        self.counters = {"hits": 0, "refinements": 0, "misses": 0, "candidates_filtered": 0}
+
+    def lookup(self, mode, key):
+        """Returns (cached key, matches) for the longest cached prefix of key, or (None, None)."""
+        for end in range(len(key), 0, -1):
+            matches = self.entries.get((mode, key[:end]))
+            if matches is not None:
+                self.entries.move_to_end((mode, key[:end]))
+                if end == len(key):
+                    self.counters["hits"] += 1
+                else:
+                    self.counters["refinements"] += 1
+                    self.counters["candidates_filtered"] += len(matches)
+                return key[:end], matches
+        self.counters["misses"] += 1
+        return None, None
+
+    def put(self, mode, key, matches):
+        if not key or len(matches) > self.max_candidates:
+            return
+        self.entries[(mode, key)] = matches
+        self.entries.move_to_end((mode, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return dict(self.counters, entries = len(self.entries))
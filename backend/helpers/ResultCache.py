@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+class ResultCache(object):
+    """Bounded LRU cache of serialized responses with a TTL.
+
+    Values are stored as bytes (the JSON body, ready to send) plus response
+    headers, and the cache is bounded both by entry count and by total body
+    bytes; the least recently used entries go first. invalidate() drops
+    everything and bumps the generation, and put() ignores results computed
+    under an older generation, so a response computed while a write was
+    committing is never cached after the invalidation.
+    """
+
+    def __init__(self, max_entries = 4096, max_bytes = 32 << 20, ttl = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        """Returns (body, headers) or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1], entry[2]
+
+    def put(self, key, body, headers = None, generation = None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, body, dict(headers or {}))
+            self.bytes += len(body)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        self.bytes -= len(self.entries.pop(key)[1])
+
+    def invalidate(self, *args):
+        """Drops every entry; accepts and ignores the (table, changes) of a MySQLDatabaseHandler.watch() listener."""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation += 1
+            self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return dict(self.counters, entries = len(self.entries), bytes = self.bytes,
+                        hit_rate = round(self.counters["hits"] / lookups, 4) if lookups else 0.0)
@@ -0,0 +1,247 @@
+import re
+
+class SQLFileReader(object):
+    """Streams statements out of a SQL dump without reading the whole file.
+
+    The file is tokenized chunk by chunk, so semicolons, quotes and comment
+    markers inside string literals ('It''s', 'a \\' b', "x;y") do not split a
+    statement. Memory use is bounded by the longest single statement.
+    """
+
+    NORMAL_TOKENS = re.compile(r"['\"`;#]|--|/\*")
+    QUOTE_TOKENS = {"'": re.compile(r"['\\]"), '"': re.compile(r'["\\]'), "`": re.compile(r"`")}
+    ROW_TOKENS = re.compile(r"['\"`()\\]")
+    TABLE_TARGET = re.compile(r"^\s*(?:(?:DROP|CREATE)\s+(?:TEMPORARY\s+)?TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?|(?:INSERT|REPLACE)(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE))*(?:\s+INTO)?"
+                              r"|ALTER(?:\s+IGNORE)?\s+TABLE|TRUNCATE(?:\s+TABLE)?|LOCK\s+TABLES|DELETE\s+FROM|UPDATE|CREATE\s+(?:UNIQUE\s+|FULLTEXT\s+|SPATIAL\s+)?INDEX\s+\S+\s+ON)"
+                              r"\s+`?(?:\w+`?\.`?)?([\w$]+)`?", re.IGNORECASE)
+    WRITE_HEAD = re.compile(r"^\s*(?:UPDATE(?:\s+(?:LOW_PRIORITY|IGNORE))*\s+`?[\w$]+`?\s+SET|DELETE(?:\s+(?:LOW_PRIORITY|QUICK|IGNORE))*\s+FROM\s+`?[\w$]+`?(?=\s|$))", re.IGNORECASE)
+    WORD_TOKENS = re.compile(r"['\"`()\\]|\b(?:WHERE|ORDER|LIMIT)\b", re.IGNORECASE)
+    ASSIGNMENT = re.compile(r"(?:\bSET|,)\s*(?:`?[\w$]+`?\s*\.\s*)?`?([\w$]+)`?\s*=", re.IGNORECASE)
+    INSERT_HEAD = re.compile(r"^\s*INSERT\s+INTO\s+(`?[\w$.]+`?)\s*(\([^()]*\))?\s*VALUES?\s*(?=\()", re.IGNORECASE)
+
+    def __init__(self, file_path, chunk_size = 1 << 16, encoding = "utf-8"):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+
+    def statements(self):
+        with open(self.file_path, "r", encoding = self.encoding) as sql_file:
+            buf = ""
+            pos = 0
+            quote = None
+            eof = False
+            while True:
+                pattern = SQLFileReader.NORMAL_TOKENS if quote is None else SQLFileReader.QUOTE_TOKENS[quote]
+                match = pattern.search(buf, pos)
+                # Every token needs one character of lookahead ('' vs ', -- vs -x, /*! vs /*)
+                if not eof and (match is None or match.end() >= len(buf)):
+                    if match is None:
+                        pos = max(pos, len(buf) - 1)
+                    chunk = sql_file.read(self.chunk_size)
+                    if chunk:
+                        buf += chunk
+                    else:
+                        eof = True
+                    continue
+                if match is None:
+                    break
+                token = match.group()
+                start, end = match.start(), match.end()
+                if quote is not None:
+                    if token == "\\":
+                        pos = end + 1
+                    elif buf[end:end + 1] == quote:
+                        pos = end + 1
+                    else:
+                        quote = None
+                        pos = end
+                elif token == ";":
+                    statement = buf[:start].strip()
+                    if statement:
+                        yield statement
+                    buf = buf[end:]
+                    pos = 0
+                elif token in ("'", '"', "`"):
+                    quote = token
+                    pos = end
+                elif token == "--" and buf[end:end + 1] not in (" ", "\t", "\r", "\n"):
+                    pos = end - 1
+                elif token == "/*":
+                    close = buf.find("*/", end)
+                    if close == -1 and not eof:
+                        chunk = sql_file.read(self.chunk_size)
+                        if chunk:
+                            buf += chunk
+                        else:
+                            eof = True
+                        continue
+                    close = len(buf) if close == -1 else close + 2
+                    if buf[end:end + 1] == "!":
+                        # MySQL executable comment, e.g. /*!40101 SET NAMES utf8 */
+                        pos = close
+                    else:
+                        buf = buf[:start] + " " + buf[close:]
+                        pos = start
+                else:
+                    newline = buf.find("\n", end)
+                    if newline == -1 and not eof:
+                        chunk = sql_file.read(self.chunk_size)
+                        if chunk:
+                            buf += chunk
+                        else:
+                            eof = True
+                        continue
+                    buf = buf[:start] + ("" if newline == -1 else buf[newline:])
+                    pos = start
+            statement = buf.strip()
+            if statement:
+                yield statement
+
+    @staticmethod
+    def statement_table(statement):
+        """Returns the table a DDL/DML statement targets, or None for session-level statements (SET, USE, ...)."""
+        match = SQLFileReader.TABLE_TARGET.match(statement)
+        return match.group(1).lower() if match else None
+
+    @staticmethod
+    def parse_insert(statement):
+        """Returns (head, values, row_count) for a plain INSERT ... VALUES statement, else None."""
+        match = SQLFileReader.INSERT_HEAD.match(statement)
+        if match is None:
+            return None
+        table, columns = match.group(1), match.group(2)
+        head = f"INSERT INTO {table}" + (f" {columns}" if columns else "")
+        values = statement[match.end():].rstrip()
+        rows = SQLFileReader.count_rows(values)
+        if rows is None:
+            return None
+        return head, values, rows
+
+    @staticmethod
+    def write_filter(statement):
+        """For a single-table UPDATE/DELETE returns its top-level "WHERE ..." condition without any trailing
+        ORDER BY/LIMIT ("" if it has none), i.e. a filter matching a superset of the rows it writes;
+        None for any other statement."""
+        if SQLFileReader.WRITE_HEAD.match(statement) is None:
+            return None
+        depth = 0
+        pos = 0
+        quote = None
+        where = None
+        end = len(statement)
+        while True:
+            match = SQLFileReader.WORD_TOKENS.search(statement, pos)
+            if match is None:
+                break
+            token, pos = match.group(), match.end()
+            if quote is not None:
+                if token == "\\" and quote != "`":
+                    pos += 1
+                elif token == quote:
+                    if statement[pos:pos + 1] == quote:
+                        pos += 1
+                    else:
+                        quote = None
+            elif token in ("'", '"', "`"):
+                quote = token
+            elif token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            elif depth == 0 and token.upper() == "WHERE" and where is None:
+                where = match.start()
+            elif depth == 0 and token.upper() in ("ORDER", "LIMIT"):
+                end = match.start()
+                break
+        return "" if where is None else statement[where:end].strip()
+
+    @staticmethod
+    def assigned_columns(statement):
+        """Lower-cased columns the SET list of an UPDATE may assign (every "col =" after SET or a comma,
+        so a superset of them); None for any other statement."""
+        if re.match(r"\s*UPDATE\b", statement, re.IGNORECASE) is None or SQLFileReader.WRITE_HEAD.match(statement) is None:
+            return None
+        return set(column.lower() for column in SQLFileReader.ASSIGNMENT.findall(statement))
+
+    @staticmethod
+    def row_values(values):
+        """Splits "(1,'a'),(2,'b')" into [["1", "'a'"], ["2", "'b'"]], keeping each value's literal text."""
+        rows = []
+        depth = 0
+        pos = 0
+        quote = None
+        start = 0
+        tokens = re.compile(r"['\"`(),\\]")
+        while True:
+            match = tokens.search(values, pos)
+            if match is None:
+                break
+            token, pos = match.group(), match.end()
+            if quote is not None:
+                if token == "\\" and quote != "`":
+                    pos += 1
+                elif token == quote:
+                    if values[pos:pos + 1] == quote:
+                        pos += 1
+                    else:
+                        quote = None
+            elif token in ("'", '"', "`"):
+                quote = token
+            elif token == "(":
+                depth += 1
+                if depth == 1:
+                    rows.append([])
+                    start = pos
+            elif token == ")":
+                depth -= 1
+                if depth == 0:
+                    rows[-1].append(values[start:match.start()].strip())
+            elif token == "," and depth == 1:
+                rows[-1].append(values[start:match.start()].strip())
+                start = pos
+        return rows
+
+    @staticmethod
+    def literal(text):
+        """Python value of a numeric or quoted SQL literal; raises ValueError for expressions, NULL, DEFAULT, ..."""
+        if len(text) >= 2 and text[0] == text[-1] and text[0] in ("'", '"'):
+            quote = text[0]
+            return re.sub(r"\\(.)|" + quote * 2, lambda m: m.group(1) or quote, text[1:-1])
+        try:
+            return int(text)
+        except ValueError:
+            return float(text)
+
+    @staticmethod
+    def count_rows(values):
+        """Counts the top-level tuples in "(...),(...)"; None if anything trails them (ON DUPLICATE KEY ...)."""
+        rows = 0
+        depth = 0
+        pos = 0
+        quote = None
+        closed_at = 0
+        while True:
+            match = SQLFileReader.ROW_TOKENS.search(values, pos)
+            if match is None:
+                break
+            token, pos = match.group(), match.end()
+            if quote is not None:
+                if token == "\\" and quote != "`":
+                    pos += 1
+                elif token == quote:
+                    if values[pos:pos + 1] == quote:
+                        pos += 1
+                    else:
+                        quote = None
+            elif token in ("'", '"', "`"):
+                quote = token
+            elif token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+                if depth == 0:
+                    rows += 1
+                    closed_at = pos
+        if quote is not None or depth != 0 or values[closed_at:].strip():
+            return None
+        return rows
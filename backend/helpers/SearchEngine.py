@@ -0,0 +1,473 @@
+import os
+import re
+import threading
+import time
+from helpers.BM25Scorer import BM25Scorer
+from helpers.BooleanQuery import BooleanQuery
+from helpers.CompletionTrie import CompletionTrie
+from helpers.FuzzyTermIndex import FuzzyTermIndex
+from helpers.IndexFile import IndexFile, IndexFileError, MappedIndex
+from helpers.InvertedIndex import InvertedIndex
+from helpers.NeighborTable import NeighborTable
+from helpers.RefinementCache import RefinementCache
+from helpers.SemanticIndex import SemanticIndex
+from helpers.SnippetBuilder import SnippetBuilder
+from helpers.TfidfRanker import TfidfRanker
+from helpers.TrigramIndex import TrigramIndex
+
+class SearchEngine(object):
+    """Serves /episodes from in-process indexes built over the episodes table.
+
+    The indexes are built on a background thread at startup. The inverted
+    index is mapped from the file written by `index_tools.py build-index` when
+    it exists, matches the table's current checksum and passes its body CRC,
+    and rebuilt from the table otherwise. Structures derived from it follow
+    one by one; a mode is served once available(mode) is True, and callers
+    fall back to SQL before. A build that fails part way withdraws every mode
+    and is retried once from the table.
+    Nothing at startup decodes the postings of a mapped index; the TF-IDF
+    matrix behind "cosine" is built by the first cosine query, and dropped by
+    every write so the next cosine query rebuilds it from the current index.
+
+    apply_changes() is registered with MySQLDatabaseHandler.watch() and keeps
+    every structure current as rows are written: upserts are appended and the
+    replaced or deleted documents tombstoned. Once tombstones and documents
+    added since the last build pass MERGE_RATIO of the index, a background
+    merge rebuilds everything from the compacted index, replays the changes
+    that arrived meanwhile and swaps the result in. Queries and writes take
+    self.lock, so a query never sees a half-applied change.
+
+    "index" and "substring" queries keep their complete match sets in a
+    RefinementCache, so the next keystroke of the same query only filters
+    those matches; set refinements to None to always search the whole index.
+
+    Modes: "index" (conjunctive term match with "phrases" and NEAR/k, or a
+    BooleanQuery when the query uses AND, OR, NOT or parentheses),
+    "substring" (title LIKE '%x%', same results as sql_search), "cosine"
+    (TF-IDF ranking), "bm25" and "bm25f" (BM25 over the whole document / per
+    field; k1 and b may be passed as options, and proximity > 0 re-ranks bm25
+    by how close together the query terms are; bm25f weighs each field by
+    field_weights, set with set_field_weights() or per query with title_weight
+    and descr_weight) and "semantic" (LSA embeddings
+    written by `index_tools.py build-lsa`, only available when that file is
+    current; nprobe may be passed when they come with an IVF index).
+    """
+
+    MODES = ("index", "substring", "cosine", "bm25", "bm25f", "semantic")
+    REQUIRES = {"index": "index", "substring": "trigrams", "cosine": "ranker", "bm25": "bm25", "bm25f": "bm25", "semantic": "semantic",
+                "similar": "neighbors", "autocomplete": "completions", "suggest": "fuzzy"}
+    # Request options each mode accepts
+    OPTIONS = {"bm25": ("k1", "b", "proximity"), "bm25f": ("k1", "b", "title_weight", "descr_weight"), "semantic": ("nprobe",)}
+    # Allowed [min, max] of the numeric options; k1 < 0 or b outside [0, 1] can zero BM25's denominators
+    OPTION_RANGES = {"k1": (0, float("inf")), "b": (0, 1), "proximity": (0, float("inf")), "nprobe": (1, float("inf"))}
+    INDEX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "indexes")
+    MERGE_RATIO = 0.1
+    # Query syntax that is not a term: boolean operators and the NEAR/k proximity operator
+    OPERATOR = re.compile(r"\b(?:AND|OR|NOT)\b|\bNEAR/\d+")
+    MERGE_MIN = 64
+
+    def __init__(self, handler, table = "episodes", batch_size = 1000, index_path = None, field_weights = None):
+        self.handler = handler
+        self.table = table
+        self.batch_size = batch_size
+        self.index_path = index_path or os.path.join(SearchEngine.INDEX_DIR, f"{table}.idx")
+        self.semantic_path = os.path.join(os.path.dirname(self.index_path), f"{table}.lsa")
+        self.field_weights = dict(field_weights or BM25Scorer.FIELD_WEIGHTS)
+        self.built = set()
+        self.index = None
+        self.ranker = None
+        self.bm25 = None
+        self.trigrams = None
+        self.completions = None
+        self.fuzzy = None
+        self.semantic = None
+        self.neighbors = None
+        self.boolean = None
+        self.snippets = SnippetBuilder()
+        self.thread = None
+        self.lock = threading.Lock()
+        # Changes received while a build or merge runs, replayed onto its result; None when none is running
+        self.log = []
+        self.ranked = 0
+        self.changes = 0
+        self.merges = 0
+        self.refinements = RefinementCache()
+        self.listeners = []
+
+    def watch(self, listener):
+        """Calls listener() whenever a build or merge has swapped in new structures (or withdrawn them after a failure),
+        i.e. whenever results computed before may differ from the ones served now."""
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                print(f"Search index listener failed: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target = self._build_quietly, name = "search-index-build", daemon = True)
+        self.thread.start()
+        return self.thread
+
+    def rows(self):
+        for batch in self.handler.query_streamer(f"SELECT id, title, descr FROM {self.table} ORDER BY id", batch_size = self.batch_size):
+            for row in batch:
+                yield row
+
+    @property
+    def ready(self):
+        return "index" in self.built
+
+    def available(self, feature):
+        return SearchEngine.REQUIRES.get(feature) in self.built
+
+    def load_index(self, mapped = True):
+        if mapped and os.path.exists(self.index_path):
+            try:
+                # The body CRC reads every page once, but decodes nothing; a corrupt file is rebuilt instead of served
+                index = IndexFile.open(self.index_path, self.handler.table_checksum(self.table), verify = True)
+                print(f"Search index mapped from {self.index_path}")
+                return index
+            except IndexFileError as e:
+                print(f"Search index file {self.index_path} not usable ({e}), rebuilding from {self.table}")
+        return InvertedIndex.build(self.rows())
+
+    def load_semantic(self):
+        if not os.path.exists(self.semantic_path + ".json"):
+            return None
+        try:
+            semantic = SemanticIndex.load(self.semantic_path, self.handler.table_checksum(self.table), self.index.tokenizer)
+            print(f"Semantic index mapped from {self.semantic_path}.docs.npy ({semantic.docs.shape[1]} dimensions)")
+            return semantic
+        except IndexFileError as e:
+            print(f"Semantic index {self.semantic_path} not usable ({e}); run index_tools.py build-lsa")
+            return None
+
+    def build(self, mapped = True):
+        started = time.perf_counter()
+        self.ranker = None
+        self.index = self.load_index(mapped)
+        self.bm25 = BM25Scorer(self.index, self.field_weights)
+        self.boolean = BooleanQuery(self.index.tokenizer)
+        self.built.update(("index", "bm25"))
+        print(f"Search index ready over {len(self.index)} {self.table} rows in {time.perf_counter() - started:.2f}s")
+        self.trigrams = TrigramIndex.build((row[1] for row in self.index.rows), self.index.tokenizer)
+        self.built.add("trigrams")
+        self.completions = CompletionTrie.build(self.index.rows, tokenizer = self.index.tokenizer)
+        self.built.add("completions")
+        self.fuzzy = FuzzyTermIndex.build(self.index.document_frequencies())
+        self.built.add("fuzzy")
+        # The TF-IDF matrix is built by the first cosine query (tfidf()), so a mapped index is not decoded at startup
+        self.ranked = len(self.index)
+        with self.lock:
+            resync = self._replay(self.log, self.fuzzy)
+            self.built.add("ranker")
+        self.semantic = self.load_semantic()
+        if self.semantic is not None:
+            self.built.add("semantic")
+            if os.path.exists(self.semantic_path + ".similar.ids.npy"):
+                neighbors = NeighborTable.load(self.semantic_path)
+                if len(neighbors.neighbors) == len(self.semantic.ids):
+                    self.neighbors = neighbors
+                    self.built.add("neighbors")
+                else:
+                    print(f"Neighbor table {self.semantic_path}.similar.*.npy does not match the semantic index; run index_tools.py build-lsa")
+        print(f"All search structures built in {time.perf_counter() - started:.2f}s")
+        self._notify()
+        if resync:
+            self.merge(resync = True)
+
+    def apply_changes(self, table, changes):
+        """Change listener for MySQLDatabaseHandler.watch(); changes of None resynchronize from the table."""
+        with self.lock:
+            if self.log is not None:
+                self.log.append(changes)
+            if "ranker" not in self.built:
+                # The startup build replays the log once it is done
+                return
+            if changes is None:
+                if self.log is None:
+                    self._start_merge(resync = True)
+                return
+            self._writable()
+            self._apply(changes, self.index, self.trigrams, self.completions, self.fuzzy)
+            if self.semantic is not None:
+                changed = self.semantic.apply(changes)
+                if self.neighbors is not None:
+                    self.neighbors.update(self.semantic, changed, self.semantic.live(self.index))
+            self.changes += len(changes)
+            if self.log is None and self.unmerged() > max(SearchEngine.MERGE_MIN, SearchEngine.MERGE_RATIO * len(self.index)):
+                self._start_merge()
+
+    def unmerged(self):
+        return len(self.index.deleted) + len(self.index) - self.ranked
+
+    def merge(self, resync = False):
+        """Rebuilds every structure from the compacted index (or from the table if resync) and swaps them in."""
+        started = time.perf_counter()
+        with self.lock:
+            index = None if resync else self.index.compacted()
+        if index is None:
+            index = InvertedIndex.build(self.rows())
+        bm25 = BM25Scorer(index)
+        trigrams = TrigramIndex.build((row[1] for row in index.rows), index.tokenizer)
+        completions = CompletionTrie.build(index.rows, tokenizer = index.tokenizer)
+        fuzzy = FuzzyTermIndex.build(index.document_frequencies()) if resync else None
+        # Only rebuilt here if a cosine query has used it since the last write
+        ranker = TfidfRanker(index) if self.ranker is not None else None
+        ranked = len(index)
+        with self.lock:
+            index, self.index = self.index, index
+            # Weights set while the merge ran
+            bm25.field_weights = dict(self.field_weights)
+            self.bm25, self.trigrams, self.completions, self.ranker, self.ranked = bm25, trigrams, completions, ranker, ranked
+            self.fuzzy = fuzzy or self.fuzzy
+            if self.refinements is not None:
+                self.refinements.clear()
+            # Changes applied to the old structures after the snapshot are applied again; upserts replace and deletes are idempotent
+            resync = self._replay(self.log, fuzzy)
+            self.merges += 1
+        print(f"Search index merged: {len(index.deleted)} tombstones dropped, {len(self.index)} documents in {time.perf_counter() - started:.2f}s")
+        self._notify()
+        if resync:
+            self.merge(resync = True)
+
+    def _start_merge(self, resync = False):
+        self.log = []
+        threading.Thread(target = self._merge_quietly, args = (resync,), name = "search-index-merge", daemon = True).start()
+
+    def _replay(self, log, fuzzy):
+        # Must hold self.lock; returns True if a change asked for a resync, in which case logging continues for it
+        resync = False
+        for changes in log:
+            if changes is None:
+                resync = True
+            else:
+                self._writable()
+                self._apply(changes, self.index, self.trigrams, self.completions, fuzzy)
+        self.log = [] if resync else None
+        return resync
+
+    def _writable(self):
+        if isinstance(self.index, MappedIndex):
+            self.index = self.index.materialize()
+            self.bm25 = BM25Scorer(self.index, self.field_weights)
+            if self.ranker is not None:
+                # Same docnos, so the TF-IDF matrix stays valid
+                self.ranker.index = self.index
+
+    def _apply(self, changes, index, trigrams, completions, fuzzy = None):
+        if self.refinements is not None:
+            self.refinements.clear()
+        # The TF-IDF matrix has a row per docno and idf over the old documents; tfidf() rebuilds it on demand
+        self.ranker = None
+        for op, key, row in changes:
+            docno = index.docnos.get(key)
+            if docno is not None:
+                trigrams.delete(docno)
+                completions.delete(docno)
+            if op == "delete":
+                index.delete(key)
+                continue
+            index.add(row)
+            trigrams.add(row[1])
+            completions.add(row[0], row[1])
+            if fuzzy is not None:
+                for term in set(index.tokenizer.tokenize(row[1] or "")).union(index.tokenizer.tokenize(row[2] or "")):
+                    fuzzy.add(term)
+
+    def search(self, query, mode = "index", limit = 10, snippets = False, **options):
+        """Results for query; with snippets, each carries a snippet of its description instead of all of it (see add_snippets).
+
+        Raises ValueError for options outside OPTION_RANGES and bm25f field weights that are not non-negative numbers.
+        """
+        with self.lock:
+            results = self._search(query, mode, limit, **options)
+            return self.add_snippets(results, self.highlight_terms(query, mode)) if snippets else results
+
+    def add_snippets(self, results, terms):
+        # Must hold self.lock. Replaces descr with snippet, highlights and title_highlights ([start, end] character offsets)
+        for result in results:
+            snippet, highlights, title_highlights = self.snippets.build(self.index, self.index.docnos[result["id"]], terms)
+            del result["descr"]
+            result.update(snippet = snippet, highlights = highlights, title_highlights = title_highlights)
+        return results
+
+    def highlight_terms(self, query, mode):
+        """Index terms to highlight for query: its terms, the completions of one still being typed, none under NOT."""
+        if BooleanQuery.is_boolean(query):
+            plan = self.boolean.plan(query)
+            return [] if plan is None else list(dict.fromkeys(BooleanQuery.positive_terms(plan)))
+        clauses, rest = self.index.parse_clauses(query)
+        terms = self.index.tokenizer.tokenize(rest)
+        if mode in ("index", "substring") and terms and not rest[-1:].isspace():
+            # Capped, since a short prefix completes to much of the vocabulary
+            terms[-1:] = self.index.terms_with_prefix(terms[-1])[:64]
+        return list(dict.fromkeys(terms + [term for clause_terms, _ in clauses for term in clause_terms]))
+
+    def _search(self, query, mode, limit, **options):
+        SearchEngine.check_options(options)
+        if mode == "cosine":
+            ranked = self.tfidf().rank(query, limit)
+        elif mode == "bm25":
+            if options.get("proximity"):
+                ranked = self.bm25.rank_proximity(query, limit, **options)
+            else:
+                options.pop("proximity", None)
+                ranked = self.bm25.rank_wand(query, limit, **options)
+        elif mode == "semantic":
+            ranked = self.semantic.rank(query, limit, self.index, **options)
+        elif mode == "bm25f":
+            weights = {field: options.pop(f"{field}_weight") for field in InvertedIndex.FIELDS if f"{field}_weight" in options}
+            SearchEngine.check_field_weights(weights)
+            ranked = self.bm25.rank_fields(query, limit, field_weights = weights or None, **options)
+        elif mode == "substring":
+            if self.refinements is None or not self.trigrams.query_key(query):
+                return [self.index.result(docno) for docno in self.trigrams.search(query, limit)]
+            return [self.index.result(docno) for docno in self._refined(self.trigrams, "substring", query)[:limit]]
+        else:
+            if BooleanQuery.is_boolean(query):
+                return self.boolean.search(self.index, query, limit)
+            if self.refinements is None or not self.index.query_key(query):
+                return self.index.search(query, limit)
+            return self.index.top(self._refined(self.index, "index", query), limit)
+        return [self.index.result(docno, score = score) for docno, score in ranked]
+
+    def tfidf(self):
+        # Must hold self.lock. The TfidfRanker, built on first use and after writes: that cosine query waits for it
+        if self.ranker is None:
+            self.ranker = TfidfRanker(self.index)
+        return self.ranker
+
+    def _refined(self, source, mode, query):
+        # Matches of query from source (an index with query_key/matches), narrowing the matches of a cached shorter query if possible
+        key = source.query_key(query)
+        cached_key, cached = self.refinements.lookup(mode, key)
+        if cached_key == key:
+            return cached
+        matches = source.matches(query, cached)
+        self.refinements.put(mode, key, matches)
+        return matches
+
+    @staticmethod
+    def check_options(options):
+        for name, value in options.items():
+            if name in SearchEngine.OPTION_RANGES:
+                low, high = SearchEngine.OPTION_RANGES[name]
+                if not isinstance(value, (int, float)) or not low <= value <= high:
+                    raise ValueError(f"{name} must be a number from {low} to {high}")
+
+    @staticmethod
+    def check_field_weights(weights):
+        for field, weight in weights.items():
+            if field not in InvertedIndex.FIELDS:
+                raise ValueError(f"unknown field {field!r}, expected one of {', '.join(InvertedIndex.FIELDS)}")
+            if not isinstance(weight, (int, float)) or not weight >= 0:
+                raise ValueError(f"weight of {field} must be a non-negative number")
+
+    def set_field_weights(self, weights):
+        """Updates the bm25f boosts of the given fields (names from InvertedIndex.FIELDS) and returns all of them.
+
+        Raises ValueError for an unknown field or a negative weight.
+        """
+        SearchEngine.check_field_weights(weights)
+        with self.lock:
+            self.field_weights.update((field, float(weight)) for field, weight in weights.items())
+            if self.bm25 is not None:
+                self.bm25.field_weights = dict(self.field_weights)
+            return dict(self.field_weights)
+
+    def similar(self, doc_id, limit = 10):
+        """Results for the precomputed nearest neighbors of the episode with id doc_id, or None if it is unknown."""
+        if not self.available("similar"):
+            return None
+        with self.lock:
+            row = self.semantic.row(doc_id)
+            if row is None or doc_id not in self.index.docnos:
+                return None
+            results = [self.index.result(self.index.docnos[neighbor], score = score)
+                       for neighbor, score in self.neighbors.similar(row) if neighbor in self.index.docnos]
+            return results[:limit]
+
+    def suggest(self, query):
+        """Returns the query with unknown terms replaced by their closest vocabulary terms, or None if none were replaced.
+
+        Everything else in the query is kept as typed, so a corrected boolean,
+        phrase or NEAR/k query means what the original did.
+
+        The last term of a query that does not end in whitespace is still being
+        typed and is left alone while it is the prefix of a known term.
+        """
+        if not self.available("suggest"):
+            return None
+        with self.lock:
+            return self._suggest(query)
+
+    def _suggest(self, query):
+        # Corrections are spliced into the query in place, so AND/OR/NOT, NEAR/k and "phrases" keep their meaning
+        operators = [match.span() for match in SearchEngine.OPERATOR.finditer(query)]
+        spans = [span for span in self.index.tokenizer.spans(query) if not any(start <= span[1] < end for start, end in operators)]
+        partial = None if query[-1:].isspace() else len(spans) - 1
+        corrected = []
+        position = 0
+        changed = False
+        for i, (term, start, end) in enumerate(spans):
+            if term in self.fuzzy or (i == partial and self.index.terms_with_prefix(term)):
+                continue
+            replacement = self.fuzzy.correct(term)
+            if replacement is not None:
+                corrected += [query[position:start], replacement]
+                position = end
+                changed = True
+        return "".join(corrected) + query[position:] if changed else None
+
+    def complete(self, prefix, limit = 10):
+        if not self.available("autocomplete"):
+            return []
+        with self.lock:
+            return self.completions.complete(prefix, limit)
+
+    def stats(self):
+        if not self.ready:
+            return {"ready": False}
+        with self.lock:
+            stats = {"ready": True, "built": sorted(self.built), "mapped": isinstance(self.index, MappedIndex), "documents": self.index.live_count(),
+                     "terms": len(self.index.postings), "tombstones": len(self.index.deleted), "changes": self.changes, "merges": self.merges}
+            stats["boolean"] = self.boolean.stats()
+            stats["field_weights"] = dict(self.field_weights)
+        if "trigrams" in self.built:
+            stats["trigram"] = self.trigrams.stats()
+        if self.refinements is not None:
+            stats["refinements"] = self.refinements.stats()
+        return stats
+
+    def _build_quietly(self):
+        try:
+            self.build()
+            return
+        except Exception as e:
+            print(f"Search index build failed, rebuilding from {self.table}: {e}")
+            with self.lock:
+                # Nothing is served from the half-built structures; writes are logged again for the retry
+                self.built.clear()
+                if self.log is None:
+                    self.log = []
+            self._notify()
+        try:
+            self.build(mapped = False)
+        except Exception as e:
+            with self.lock:
+                self.built.clear()
+                self.log = None
+            self._notify()
+            print(f"Search index build failed, serving from SQL: {e}")
+
+    def _merge_quietly(self, resync):
+        try:
+            self.merge(resync)
+        except Exception as e:
+            with self.lock:
+                self.log = None
+            print(f"Search index merge failed, keeping the current index: {e}")
@@ -0,0 +1,204 @@
+import json
+import math
+import os
+from collections import Counter
+import numpy as np
+from helpers.IndexFile import IndexFileError
+from helpers.IvfIndex import IvfIndex
+from helpers.TfidfRanker import TfidfRanker
+
+class SemanticIndex(object):
+    """Latent semantic search over dense document embeddings.
+
+    train() takes a truncated SVD A ~ U S V^T of the row-normalized TF-IDF
+    matrix A of a TfidfRanker; documents are embedded as the rows of A V ~ U S
+    and a query's TF-IDF vector q is projected the same way, as q V, so terms
+    that co-occur ("divorce", "breakup", "split") land close together. Both
+    embeddings are L2-normalized float32, which makes ranking one
+    matrix-vector product and an argpartition.
+
+    Saved as three files next to the inverted index: <path>.docs.npy (the
+    document matrix, memory-mapped on load), <path>.terms.npy (V) and
+    <path>.json (vocabulary, idf, document ids and the source table checksum).
+    Documents deleted since training are skipped. apply() folds written
+    rows in by projecting their text like a query, which is how the trained
+    documents were embedded too; the first write copies the mapped matrix
+    into memory.
+
+    Large corpora also get an IvfIndex (<path>.ivf.npz) so a query only scores
+    the documents in the clusters closest to it instead of all of them.
+    """
+
+    def __init__(self, ids, docs, terms, term_vectors, idf, sublinear_tf = True, tokenizer = None, source_checksum = 0):
+        self.ids = ids
+        self.docs = docs
+        self.terms = terms
+        self.columns = {term: column for column, term in enumerate(terms)}
+        self.term_vectors = term_vectors
+        self.idf = idf
+        self.sublinear_tf = sublinear_tf
+        self.tokenizer = tokenizer
+        self.source_checksum = source_checksum
+        self.ann = None
+        self._rows = None
+        self._live = None
+        self._live_for = None
+
+    @classmethod
+    def train(cls, ranker, dims = 128, n_lists = 0, iterations = 4, seed = 0):
+        """Embeds ranker's documents in dims dimensions; n_lists > 0 also clusters them into an IvfIndex."""
+        dims = max(1, min(dims, min(ranker.matrix.shape) - 1))
+        _, _, vt = SemanticIndex.truncated_svd(ranker.matrix, dims, iterations = iterations, seed = seed)
+        term_vectors = np.ascontiguousarray(vt.T, dtype = np.float32)
+        # A V rather than U S: equal for an exact SVD, and exactly what apply() computes for a written row
+        docs = SemanticIndex.normalize_rows(np.asarray(ranker.matrix.dot(term_vectors), dtype = np.float32))
+        ids = np.fromiter((row[0] for row in ranker.index.rows), dtype = np.int64, count = len(ranker.index.rows))
+        semantic = cls(ids, docs, list(ranker.terms), term_vectors, ranker.idf, ranker.sublinear_tf, ranker.tokenizer)
+        if n_lists:
+            semantic.ann = IvfIndex.build(docs, n_lists, seed = seed)
+        return semantic
+
+    @staticmethod
+    def truncated_svd(matrix, dims, oversample = 10, iterations = 4, seed = 0):
+        """Randomized SVD (Halko, Martinsson and Tropp): the top dims singular triplets of a sparse matrix.
+
+        The range of the matrix is captured by multiplying it with a random
+        Gaussian block, sharpened with a few power iterations, and the small
+        projected matrix is decomposed exactly with np.linalg.svd.
+        """
+        rng = np.random.RandomState(seed)
+        width = min(dims + oversample, min(matrix.shape))
+        basis, _ = np.linalg.qr(matrix.dot(rng.standard_normal((matrix.shape[1], width)).astype(np.float32)))
+        for _ in range(iterations):
+            basis, _ = np.linalg.qr(matrix.T.dot(basis))
+            basis, _ = np.linalg.qr(matrix.dot(basis))
+        projected = np.asarray(matrix.T.dot(basis)).T
+        u, s, vt = np.linalg.svd(projected, full_matrices = False)
+        return basis.dot(u)[:, :dims], s[:dims], vt[:dims]
+
+    @staticmethod
+    def normalize_rows(matrix):
+        return matrix / np.maximum(np.linalg.norm(matrix, axis = 1, keepdims = True), 1e-12)
+
+    def save(self, path, source_checksum = 0):
+        """Writes the three files for path (temp files + rename, metadata last) and returns their total size."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        size = 0
+        for suffix, array in ((".docs.npy", self.docs), (".terms.npy", self.term_vectors)):
+            with open(path + suffix + ".tmp", "wb") as array_file:
+                np.save(array_file, np.ascontiguousarray(array, dtype = np.float32))
+                size += array_file.tell()
+            os.replace(path + suffix + ".tmp", path + suffix)
+        if self.ann is not None:
+            size += self.ann.save(path + ".ivf.npz")
+        elif os.path.exists(path + ".ivf.npz"):
+            os.remove(path + ".ivf.npz")
+        meta = {"source_checksum": source_checksum, "dims": int(self.docs.shape[1]), "sublinear_tf": self.sublinear_tf,
+                "ids": [int(doc_id) for doc_id in self.ids], "terms": self.terms, "idf": [float(idf) for idf in self.idf]}
+        with open(path + ".json.tmp", "w", encoding = "utf-8") as meta_file:
+            json.dump(meta, meta_file)
+            size += meta_file.tell()
+        os.replace(path + ".json.tmp", path + ".json")
+        return size
+
+    @classmethod
+    def load(cls, path, source_checksum = None, tokenizer = None):
+        """Maps the document matrix at path; raises IndexFileError if the files are missing, inconsistent or stale."""
+        try:
+            with open(path + ".json", "r", encoding = "utf-8") as meta_file:
+                meta = json.load(meta_file)
+            docs = np.load(path + ".docs.npy", mmap_mode = "r")
+            term_vectors = np.load(path + ".terms.npy")
+        except (OSError, ValueError) as e:
+            raise IndexFileError(f"semantic index {path} not readable: {e}")
+        if source_checksum is not None and meta["source_checksum"] != source_checksum:
+            raise IndexFileError("semantic index is stale: the source table has changed since it was built")
+        if docs.shape != (len(meta["ids"]), meta["dims"]) or term_vectors.shape != (len(meta["terms"]), meta["dims"]):
+            raise IndexFileError("semantic index files do not match each other")
+        semantic = cls(np.asarray(meta["ids"], dtype = np.int64), docs, meta["terms"], term_vectors, np.asarray(meta["idf"], dtype = np.float32),
+                       meta["sublinear_tf"], tokenizer, meta["source_checksum"])
+        if os.path.exists(path + ".ivf.npz"):
+            try:
+                semantic.ann = IvfIndex.load(path + ".ivf.npz")
+            except (OSError, ValueError, KeyError) as e:
+                raise IndexFileError(f"semantic index {path}.ivf.npz not readable: {e}")
+            if semantic.ann.offsets[-1] != len(semantic.ids):
+                raise IndexFileError("semantic index files do not match each other")
+        return semantic
+
+    def _tf(self, tf):
+        return 1.0 + math.log(tf) if self.sublinear_tf else float(tf)
+
+    def query_vector(self, query):
+        """The query's normalized TF-IDF vector projected into the embedding space, or None if no term is known."""
+        counts = Counter(term for term in self.tokenizer.tokenize(query) if term in self.columns)
+        if not counts:
+            return None
+        columns = np.fromiter((self.columns[term] for term in counts), dtype = np.int64, count = len(counts))
+        weights = np.fromiter((self._tf(tf) for tf in counts.values()), dtype = np.float32, count = len(counts)) * self.idf[columns]
+        vector = weights.dot(self.term_vectors[columns])
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def rank(self, query, limit, index, nprobe = None, exact = False):
+        """Returns up to limit (docno in index, score) pairs, best first; documents no longer in index are skipped.
+
+        Uses the IvfIndex when there is one, unless exact; nprobe overrides its default number of probed lists.
+        """
+        vector = self.query_vector(query)
+        if vector is None:
+            return []
+        return [(index.docnos[int(self.ids[row])], score) for row, score in self.top_rows(vector, limit, self.live(index), nprobe, exact)]
+
+    def top_rows(self, vector, limit, live = None, nprobe = None, exact = False):
+        """[(row, score)] of the best limit rows for an embedding-space vector, among live rows (a boolean mask) if given."""
+        if self.ann is None or exact:
+            scores = self.docs.dot(vector)
+            if live is not None:
+                scores[~live] = 0
+            return TfidfRanker.top_k(scores, limit)
+        rows, scores = self.ann.search(self.docs, vector, nprobe)
+        if live is not None:
+            scores[~live[rows]] = 0
+        return [(int(rows[i]), score) for i, score in TfidfRanker.top_k(scores, limit)]
+
+    def row(self, doc_id):
+        if self._rows is None:
+            self._rows = {int(doc_id): row for row, doc_id in enumerate(self.ids)}
+        return self._rows.get(doc_id)
+
+    def apply(self, changes):
+        """Folds in the rows of ("upsert"/"delete", id, row) changes; returns the embedding rows that changed."""
+        if not self.docs.flags.writeable:
+            self.docs = np.array(self.docs)
+        changed = []
+        added = []
+        for op, doc_id, values in changes:
+            row = self.row(doc_id)
+            if op == "delete":
+                if row is not None:
+                    changed.append(row)
+                continue
+            vector = self.query_vector(f"{values[1] or ''} {values[2] or ''}")
+            vector = np.zeros(self.docs.shape[1], dtype = np.float32) if vector is None else vector
+            if row is None:
+                row = self._rows[doc_id] = len(self.ids) + len(added)
+                added.append(vector)
+                self.ids = np.append(self.ids, doc_id)
+            else:
+                self.docs[row] = vector
+            changed.append(row)
+        if added:
+            self.docs = np.concatenate([self.docs, np.asarray(added, dtype = np.float32)])
+        if self.ann is not None:
+            self.ann.add(changed)
+        self._live_for = None
+        return np.unique(np.asarray(changed, dtype = np.int64))
+
+    def live(self, index):
+        # Rows whose document is still in index, recomputed after every index write
+        if self._live_for != (index, index.version):
+            docnos = index.docnos
+            self._live = np.fromiter((int(doc_id) in docnos for doc_id in self.ids), dtype = bool, count = len(self.ids))
+            self._live_for = (index, index.version)
+        return self._live
@@ -0,0 +1,75 @@
+from helpers.InvertedIndex import InvertedIndex
+
+class SnippetBuilder(object):
+    """Cuts the best window of a result's description and marks where the query terms are.
+
+    Everything comes from the index: the positions of the query terms in the
+    document (from their postings) say which description tokens match, and
+    the document's token offsets turn token numbers into character offsets,
+    so no document is tokenized per request. The window is the `window`
+    consecutive description tokens holding the most distinct query terms,
+    then the most matches; descriptions without a match start at the top.
+    """
+
+    ELLIPSIS = "…"
+
+    def __init__(self, window = 20):
+        self.window = window
+
+    def build(self, index, docno, terms):
+        """Returns (snippet, highlights, title_highlights); highlights are [start, end] character offsets into the snippet and the title."""
+        title_length = index.field_lengths[0][docno]
+        descr_length = index.field_lengths[1][docno]
+        descr_start = title_length + InvertedIndex.FIELD_GAP
+        offsets = index.token_offsets(docno)
+        title_hits = set()
+        hits = []
+        for number, term in enumerate(terms):
+            for position in index.positions(term, docno):
+                if position < title_length:
+                    title_hits.add(position)
+                elif position >= descr_start:
+                    hits.append((position - descr_start, number))
+        hits.sort()
+        start, end = self.best_window(hits, descr_length)
+        descr = index.rows[docno][2]
+        if start == end:
+            return descr, [], self.spans(offsets, sorted(title_hits), 0)
+        # Description token t is the (title_length + t)-th start, end pair
+        first, last = 2 * (title_length + start), 2 * (title_length + end - 1) + 1
+        snippet = descr[offsets[first]:offsets[last]]
+        shift = offsets[first]
+        if start > 0:
+            snippet = SnippetBuilder.ELLIPSIS + snippet
+            shift -= len(SnippetBuilder.ELLIPSIS)
+        if end < descr_length:
+            snippet += SnippetBuilder.ELLIPSIS
+        highlights = self.spans(offsets, sorted({title_length + token for token, _ in hits if start <= token < end}), shift)
+        return snippet, highlights, self.spans(offsets, sorted(title_hits), 0)
+
+    @staticmethod
+    def spans(offsets, tokens, shift):
+        # [start, end] of each token number, moved back by shift
+        return [[offsets[2 * token] - shift, offsets[2 * token + 1] - shift] for token in tokens]
+
+    def best_window(self, hits, length):
+        """[start, end) token range of at most window tokens around the best-covered run of hits ((token, term number), ascending)."""
+        if not hits:
+            return 0, min(self.window, length)
+        best = None
+        counts = {}
+        lo = 0
+        for hi, (token, number) in enumerate(hits):
+            counts[number] = counts.get(number, 0) + 1
+            while token - hits[lo][0] >= self.window:
+                counts[hits[lo][1]] -= 1
+                if not counts[hits[lo][1]]:
+                    del counts[hits[lo][1]]
+                lo += 1
+            score = (len(counts), hi - lo + 1)
+            if best is None or score > best[0]:
+                best = (score, hits[lo][0], token)
+        _, first, last = best
+        # Centre the matched run in the window
+        start = max(0, min(first - (self.window - 1 - (last - first)) // 2, length - self.window))
+        return start, min(length, start + self.window)
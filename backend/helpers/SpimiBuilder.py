@@ -0,0 +1,229 @@
+import heapq
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+from array import array
+from collections import deque
+from helpers.IndexFile import IndexFile
+from helpers.InvertedIndex import InvertedIndex, Postings
+
+class SpimiBuilder(object):
+    """Writes an IndexFile from a stream of rows without holding the whole index in memory (single-pass in-memory indexing).
+
+    Rows are cut into blocks of about block_bytes of text and numbered as they
+    arrive. Each block is indexed on its own by a worker process
+    (build_block), which writes a run: the block's terms in sorted order with
+    their postings already in the final POSTINGS encoding, and the block's
+    document sections. Only a bounded number of blocks is in flight, so
+    memory stays at a few blocks per worker however large the table is.
+    merge() then k-way merges the runs by term with a heap. Blocks hold
+    consecutive docnos, so merging a term's postings only concatenates them,
+    re-encoding the first docno gap of each run. The result is the same file
+    IndexFile.write() produces for the same rows.
+    """
+
+    # Run record header: term bytes, document frequency, last docno, postings bytes
+    RECORD = struct.Struct("<IIII")
+    DOC_SECTIONS = ("DOC_LENGTHS", "DOC_IDS", "DOC_OFFSETS", "DOC_BLOB", "TOKEN_STARTS", "TOKEN_OFFSETS")
+    CHUNK = 1 << 20
+
+    def __init__(self, workers = None, block_bytes = 16 << 20, temp_dir = None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.block_bytes = block_bytes
+        self.temp_dir = temp_dir
+        self.stats = {}
+
+    def build(self, rows, path, source_checksum = 0):
+        """Indexes rows ((id, title, descr), in docno order) into the index file at path; returns its size."""
+        started = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        run_dir = tempfile.mkdtemp(prefix = "spimi-", dir = self.temp_dir or os.path.dirname(os.path.abspath(path)))
+        pool = multiprocessing.Pool(self.workers) if self.workers > 0 else None
+        try:
+            runs = []
+            pending = deque()
+            n_docs = 0
+            text_bytes = 0
+            for block in self.blocks(rows):
+                args = (os.path.join(run_dir, f"run-{len(runs) + len(pending):05}"), n_docs, block)
+                n_docs += len(block)
+                text_bytes += sum(len(row[1] or "") + len(row[2] or "") for row in block)
+                if pool is None:
+                    runs.append(SpimiBuilder.build_block(*args))
+                    continue
+                pending.append(pool.apply_async(SpimiBuilder.build_block, args))
+                # Blocks wait in the pool's queue; bounding them bounds the memory of rows read ahead
+                while len(pending) > 2 * self.workers:
+                    runs.append(pending.popleft().get())
+            while pending:
+                runs.append(pending.popleft().get())
+            indexed = time.perf_counter()
+            size, n_terms = self.merge(runs, run_dir, path, n_docs, source_checksum)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            shutil.rmtree(run_dir, ignore_errors = True)
+        elapsed = time.perf_counter() - started
+        self.stats = {"documents": n_docs, "terms": n_terms, "runs": len(runs), "bytes": size, "text_bytes": text_bytes,
+                      "index_seconds": indexed - started, "merge_seconds": elapsed - (indexed - started), "seconds": elapsed,
+                      "docs_per_second": n_docs / max(elapsed, 1e-9), "text_mb_per_second": text_bytes / max(elapsed, 1e-9) / (1 << 20),
+                      "peak_rss_mb": SpimiBuilder.peak_rss(), "peak_worker_rss_mb": SpimiBuilder.peak_rss(children = True)}
+        return size
+
+    @staticmethod
+    def peak_rss(children = False):
+        """Peak resident set size in MB of this process (or its largest waited-for child), None where the resource module is missing (Windows)."""
+        try:
+            import resource
+        except ImportError:
+            return None
+        # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def blocks(self, rows):
+        block = []
+        size = 0
+        for row in rows:
+            block.append((row[0], row[1] or "", row[2] or ""))
+            size += len(block[-1][1]) + len(block[-1][2])
+            if size >= self.block_bytes:
+                yield block
+                block = []
+                size = 0
+        if block:
+            yield block
+
+    @staticmethod
+    def build_block(path, base, rows):
+        """Indexes rows as docnos base, base + 1, ... and writes the run files path.terms and path.docs.
+
+        Returns (path, base, documents, token offsets, doc blob bytes, byte length of each of DOC_SECTIONS in path.docs).
+        """
+        index = InvertedIndex.build(rows)
+        with open(path + ".terms", "wb") as run_file:
+            for term in sorted(index.postings):
+                postings = index.postings[term]
+                blob = bytearray()
+                IndexFile.encode_postings(postings, blob, base)
+                encoded = term.encode("utf-8")
+                run_file.write(SpimiBuilder.RECORD.pack(len(encoded), len(postings), base + postings.docnos[-1], len(blob)))
+                run_file.write(encoded)
+                run_file.write(blob)
+        doc_blob = bytearray()
+        doc_offsets = array("Q")
+        for row in index.rows:
+            doc_blob += (row[1] + "\0" + row[2]).encode("utf-8")
+            doc_offsets.append(len(doc_blob))
+        token_offsets = array("I")
+        token_starts = array("Q")
+        for docno in range(len(index.rows)):
+            token_offsets.extend(index.token_offsets(docno))
+            token_starts.append(len(token_offsets))
+        # Offsets are relative to the block (without the leading 0); merge() adds the preceding blocks' totals
+        sections = [b"".join(array("I", lengths).tobytes() for lengths in index.field_lengths), array("q", (row[0] for row in index.rows)).tobytes(),
+                    doc_offsets.tobytes(), bytes(doc_blob), token_starts.tobytes(), token_offsets.tobytes()]
+        with open(path + ".docs", "wb") as run_file:
+            for section in sections:
+                run_file.write(section)
+        return path, base, len(index.rows), len(token_offsets), len(doc_blob), [len(section) for section in sections]
+
+    @staticmethod
+    def read_run(path, number):
+        """(term, number, df, last docno, postings) for the terms in a run's terms file, in term order; number breaks ties in the merge."""
+        with open(path + ".terms", "rb") as run_file:
+            while True:
+                header = run_file.read(SpimiBuilder.RECORD.size)
+                if not header:
+                    return
+                term_length, df, last, length = SpimiBuilder.RECORD.unpack(header)
+                yield run_file.read(term_length).decode("utf-8"), number, df, last, run_file.read(length)
+
+    @staticmethod
+    def first_gap(blob):
+        """(first varint of blob, its length in bytes)."""
+        value = shift = 0
+        for i, byte in enumerate(blob):
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, i + 1
+            shift += 7
+
+    def merge(self, runs, run_dir, path, n_docs, source_checksum):
+        """k-way merges the runs' terms into the term and postings sections (temp files in run_dir), then writes the file; returns (size, terms)."""
+        names = ("TERM_OFFSETS", "TERM_BLOB", "TERM_ENTRIES", "POSTINGS")
+        files = {name: open(os.path.join(run_dir, name), "w+b") for name in names}
+        try:
+            files["TERM_OFFSETS"].write(array("I", [0]).tobytes())
+            term_bytes = postings_bytes = n_terms = 0
+            start = term_df = previous = 0
+            merged = heapq.merge(*[SpimiBuilder.read_run(run[0], number) for number, run in enumerate(runs)])
+            current = None
+            for term, _, df, last, blob in merged:
+                if term != current:
+                    if current is not None:
+                        files["TERM_ENTRIES"].write(IndexFile.TERM_ENTRY.pack(start, postings_bytes - start, term_df))
+                    current, start, term_df, previous = term, postings_bytes, 0, 0
+                    encoded = term.encode("utf-8")
+                    files["TERM_BLOB"].write(encoded)
+                    term_bytes += len(encoded)
+                    files["TERM_OFFSETS"].write(array("I", [term_bytes]).tobytes())
+                    n_terms += 1
+                # The run's first gap counts from docno 0; re-base it on this term's last docno so far
+                first, length = SpimiBuilder.first_gap(blob)
+                gap = bytearray()
+                Postings.encode_varint(first - previous, gap)
+                files["POSTINGS"].write(gap)
+                files["POSTINGS"].write(blob[length:])
+                postings_bytes += len(gap) + len(blob) - length
+                term_df += df
+                previous = last
+            if current is not None:
+                files["TERM_ENTRIES"].write(IndexFile.TERM_ENTRY.pack(start, postings_bytes - start, term_df))
+            sections = [self.read_file(files[name]) for name in names] + [self.doc_section(runs, name) for name in SpimiBuilder.DOC_SECTIONS]
+            return IndexFile.write_sections(path, n_docs, n_terms, source_checksum, sections), n_terms
+        finally:
+            for run_file in files.values():
+                run_file.close()
+                os.remove(run_file.name)
+
+    @staticmethod
+    def read_file(run_file):
+        run_file.flush()
+        run_file.seek(0)
+        while True:
+            chunk = run_file.read(SpimiBuilder.CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def doc_section(runs, name):
+        """Chunks of the document section name, concatenated from the runs' docs files."""
+        i = SpimiBuilder.DOC_SECTIONS.index(name)
+        if name in ("DOC_OFFSETS", "TOKEN_STARTS"):
+            yield array("Q", [0]).tobytes()
+        # DOC_LENGTHS is field-major: every document's title length, then every description length
+        for field in range(len(InvertedIndex.FIELDS)) if name == "DOC_LENGTHS" else [None]:
+            total = 0
+            for path, _, n_docs, n_token_offsets, blob_bytes, lengths in runs:
+                with open(path + ".docs", "rb") as run_file:
+                    run_file.seek(sum(lengths[:i]))
+                    if field is not None:
+                        run_file.seek(field * n_docs * 4, os.SEEK_CUR)
+                        yield run_file.read(n_docs * 4)
+                        continue
+                    remaining = lengths[i]
+                    while remaining:
+                        chunk = run_file.read(min(remaining, SpimiBuilder.CHUNK))
+                        remaining -= len(chunk)
+                        if name in ("DOC_OFFSETS", "TOKEN_STARTS"):
+                            chunk = array("Q", chunk)
+                            for j in range(len(chunk)):
+                                chunk[j] += total
+                            chunk = chunk.tobytes()
+                        yield chunk
+                total += blob_bytes if name == "DOC_OFFSETS" else n_token_offsets
@@ -0,0 +1,76 @@
+import math
+from collections import Counter
+import numpy as np
+import scipy.sparse as sp
+
+class TfidfRanker(object):
+    """Cosine ranking over a sparse TF-IDF document-term matrix.
+
+    Rows of the CSR matrix are scaled by their precomputed L2 norms at build
+    time, so a query costs one sparse matrix-vector product followed by an
+    argpartition over the scores, with no per-query normalization of documents.
+    """
+
+    def __init__(self, index, sublinear_tf = True):
+        self.index = index
+        self.tokenizer = index.tokenizer
+        self.sublinear_tf = sublinear_tf
+        self.terms = sorted(index.postings)
+        self.columns = {term: column for column, term in enumerate(self.terms)}
+        n_docs = len(index)
+        self.idf = np.empty(len(self.terms), dtype = np.float32)
+        indptr, docnos, weights = [0], [], []
+        for column, term in enumerate(self.terms):
+            postings = index.postings[term]
+            self.idf[column] = math.log((n_docs + 1) / (len(postings) + 1)) + 1
+            docnos.extend(postings.docnos)
+            weights.extend(self._tf(tf) * self.idf[column] for tf in postings.tfs)
+            indptr.append(len(docnos))
+        # Postings are per term, i.e. columns; assemble as CSC and convert once to row-major CSR
+        matrix = sp.csc_matrix((np.asarray(weights, dtype = np.float32), np.asarray(docnos, dtype = np.int32), np.asarray(indptr, dtype = np.int64)),
+                               shape = (n_docs, len(self.terms))).tocsr()
+        self.doc_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis = 1)).ravel())
+        self.matrix = sp.diags(1.0 / np.maximum(self.doc_norms, 1e-12)).dot(matrix).tocsr().astype(np.float32)
+
+    def _tf(self, tf):
+        return 1.0 + math.log(tf) if self.sublinear_tf else float(tf)
+
+    def query_vector(self, query):
+        counts = Counter(term for term in self.tokenizer.tokenize(query) if term in self.columns)
+        columns = np.fromiter((self.columns[term] for term in counts), dtype = np.int32, count = len(counts))
+        weights = np.fromiter((self._tf(tf) for tf in counts.values()), dtype = np.float32, count = len(counts)) * self.idf[columns]
+        norm = np.linalg.norm(weights)
+        if norm > 0:
+            weights /= norm
+        return sp.csr_matrix((weights, columns, np.array([0, len(columns)])), shape = (1, len(self.terms)))
+
+    def rank(self, query, limit = 10):
+        """Returns up to limit (docno, score) pairs with a positive cosine score, best first."""
+        vector = self.query_vector(query)
+        if vector.nnz == 0:
+            return []
+        scores = self.matrix.dot(vector.T).toarray().ravel()
+        return TfidfRanker.top_k(self._drop_deleted(scores), limit)
+
+    def rank_batch(self, queries, limit = 10):
+        """Scores many queries with one matrix-matrix product; returns one ranking per query."""
+        if not queries:
+            return []
+        scores = self._drop_deleted(self.matrix.dot(sp.vstack([self.query_vector(query) for query in queries]).T).toarray())
+        return [TfidfRanker.top_k(scores[:, i], limit) for i in range(len(queries))]
+
+    def _drop_deleted(self, scores):
+        # Documents tombstoned in the index after the matrix was built; documents added since are not in it until the next build
+        deleted = [docno for docno in self.index.deleted if docno < scores.shape[0]]
+        if deleted:
+            scores[deleted] = 0
+        return scores
+
+    @staticmethod
+    def top_k(scores, limit):
+        k = min(limit, int(np.count_nonzero(scores > 0)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(int(docno), float(scores[docno])) for docno in top]
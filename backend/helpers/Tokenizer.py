@@ -0,0 +1,39 @@
+import re
+import unicodedata
+
+class Tokenizer(object):
+    """Lowercases, strips accents and splits text into word terms.
+
+    normalize() folds text the way the title_norm column compares: the
+    column only stores LOWER(title), and its utf8mb4_unicode_ci collation
+    ignores case and accents, so "Khloé" and "khloe" share a term here too.
+    spans() also returns where each term came from in the original text.
+    """
+
+    TOKEN = re.compile(r"\w+")
+
+    def __init__(self, min_length = 1):
+        self.min_length = min_length
+
+    def normalize(self, text):
+        decomposed = unicodedata.normalize("NFKD", text.casefold())
+        return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    def tokenize(self, text):
+        return [term for term in Tokenizer.TOKEN.findall(self.normalize(text)) if len(term) >= self.min_length]
+
+    def spans(self, text):
+        """[(term, start, end)] for the terms tokenize() returns, with character offsets into text."""
+        if text.isascii():
+            normalized, origin = text.lower(), None
+        else:
+            # Normalizing may drop (accents) or add (ligatures) characters, so map each normalized character back
+            pieces = [self.normalize(c) for c in text]
+            normalized = "".join(pieces)
+            origin = [i for i, piece in enumerate(pieces) for _ in piece] + [len(text)]
+        spans = []
+        for match in Tokenizer.TOKEN.finditer(normalized):
+            if len(match.group()) >= self.min_length:
+                start, end = match.span()
+                spans.append((match.group(), start, end) if origin is None else (match.group(), origin[start], origin[end - 1] + 1))
+        return spans
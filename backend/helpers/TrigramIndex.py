@@ -0,0 +1,112 @@
+from bisect import bisect_left
+from helpers.Tokenizer import Tokenizer
+
+class TrigramIndex(object):
+    """Substring search (LIKE '%x%') over normalized text via trigram postings.
+
+    A document can only contain the query if it contains every trigram of the
+    query, so intersecting those postings yields a small candidate set and
+    only the candidates are checked with a real substring test. Texts are
+    padded with two NUL characters before indexing; queries of one or two
+    characters are then a prefix of some indexed trigram, which the sorted
+    trigram list finds by binary search.
+    """
+
+    PAD = "\x00\x00"
+
+    def __init__(self, tokenizer = None):
+        self.tokenizer = tokenizer or Tokenizer()
+        self.texts = []
+        self.postings = {}
+        self.deleted = set()
+        self._grams = None
+        self.queries = 0
+        self.candidates = 0
+        self.matched = 0
+
+    @classmethod
+    def build(cls, texts, tokenizer = None):
+        index = cls(tokenizer)
+        for text in texts:
+            index.add(text)
+        return index
+
+    def add(self, text):
+        docno = len(self.texts)
+        text = self.tokenizer.normalize(text or "")
+        self.texts.append(text)
+        for gram in TrigramIndex.trigrams(text + TrigramIndex.PAD):
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = []
+            postings.append(docno)
+        self._grams = None
+        return docno
+
+    def delete(self, docno):
+        self.deleted.add(docno)
+
+    @staticmethod
+    def trigrams(text):
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def search(self, query, limit = 10):
+        """Returns the first limit docnos (in docno order) whose text contains query."""
+        query = self.tokenizer.normalize(query)
+        self.queries += 1
+        if not query:
+            return [docno for docno, _ in zip((docno for docno in range(len(self.texts)) if docno not in self.deleted), range(limit))]
+        candidates = self._candidates(query)
+        matches = []
+        for docno in candidates:
+            self.candidates += 1
+            if query in self.texts[docno] and docno not in self.deleted:
+                matches.append(docno)
+                if len(matches) == limit:
+                    break
+        self.matched += len(matches)
+        return matches
+
+    def query_key(self, query):
+        return self.tokenizer.normalize(query)
+
+    def matches(self, query, candidates = None):
+        """Every docno (in docno order) whose text contains query, checking only candidates if given."""
+        query = self.tokenizer.normalize(query)
+        if candidates is None:
+            candidates = self._candidates(query)
+        return [docno for docno in candidates if query in self.texts[docno] and docno not in self.deleted]
+
+    def _candidates(self, query):
+        if len(query) < 3:
+            docnos = set()
+            for gram in self._grams_with_prefix(query):
+                docnos.update(self.postings[gram])
+            return sorted(docnos)
+        lists = []
+        for gram in TrigramIndex.trigrams(query):
+            postings = self.postings.get(gram)
+            if postings is None:
+                return []
+            lists.append(postings)
+        lists.sort(key = len)
+        docnos = set(lists[0])
+        for postings in lists[1:]:
+            docnos.intersection_update(postings)
+            if not docnos:
+                return []
+        return sorted(docnos)
+
+    def _grams_with_prefix(self, prefix):
+        if self._grams is None:
+            self._grams = sorted(self.postings)
+        grams = []
+        for i in range(bisect_left(self._grams, prefix), len(self._grams)):
+            if not self._grams[i].startswith(prefix):
+                break
+            grams.append(self._grams[i])
+        return grams
+
+    def stats(self):
+        return {"queries": self.queries, "documents": len(self.texts) - len(self.deleted), "candidates_verified": self.candidates, "matches": self.matched,
+                "verified_per_query": round(self.candidates / self.queries, 2) if self.queries else 0.0}
@@ -0,0 +1,211 @@
+"""Offline commands for the in-process search indexes.
+
+Run from the backend folder, against the same MySQL database as app.py:
+
+    python index_tools.py build-index
+    python index_tools.py bench-wand
+    python index_tools.py bench-typing
+    python index_tools.py build-lsa
+    python index_tools.py bench-ann
+"""
+import argparse
+import math
+import time
+import numpy as np
+from helpers.BM25Scorer import BM25Scorer
+from helpers.IndexFile import IndexFile
+from helpers.InvertedIndex import InvertedIndex
+from helpers.IvfIndex import IvfIndex
+from helpers.MySQLDatabaseHandler import MySQLDatabaseHandler
+from helpers.NeighborTable import NeighborTable
+from helpers.RefinementCache import RefinementCache
+from helpers.SearchEngine import SearchEngine
+from helpers.SemanticIndex import SemanticIndex
+from helpers.SpimiBuilder import SpimiBuilder
+from helpers.TfidfRanker import TfidfRanker
+from helpers.Tokenizer import Tokenizer
+
+def connect(args):
+    return MySQLDatabaseHandler(args.user, args.password, args.port, args.database, args.host)
+
+def load_index(args):
+    return InvertedIndex.build(SearchEngine(connect(args), args.table).rows())
+
+def read_queries(args, index):
+    if args.queries:
+        with open(args.queries, "r", encoding = "utf-8") as query_file:
+            return [line.strip() for line in query_file if line.strip()]
+    # Default workload: every title (short queries) and description (long multi-term queries)
+    return [row[1] for row in index.rows] + [row[2] for row in index.rows]
+
+def megabytes(value):
+    return "unavailable" if value is None else f"{value:.0f} MB"
+
+def build_index(args):
+    handler = connect(args)
+    engine = SearchEngine(handler, args.table, index_path = args.output)
+    # Taken before reading the rows, so a write that races the build makes the file stale rather than wrong
+    checksum = handler.table_checksum(args.table)
+    started = time.perf_counter()
+    if args.in_memory:
+        index = InvertedIndex.build(engine.rows())
+        size = IndexFile.write(index, engine.index_path, checksum)
+        print(f"Wrote {engine.index_path}: {len(index)} documents, {len(index.postings)} terms, {size} bytes in {time.perf_counter() - started:.2f}s, "
+              f"peak RSS {megabytes(SpimiBuilder.peak_rss())}")
+        return
+    builder = SpimiBuilder(args.workers, int(args.block_mb * (1 << 20)), args.temp_dir)
+    builder.build(engine.rows(), engine.index_path, checksum)
+    stats = builder.stats
+    print(f"Wrote {engine.index_path}: {stats['documents']} documents, {stats['terms']} terms, {stats['bytes']} bytes from {stats['runs']} runs "
+          f"in {stats['seconds']:.2f}s ({stats['index_seconds']:.2f}s indexing with {builder.workers} workers, {stats['merge_seconds']:.2f}s merging)")
+    print(f"Throughput {stats['docs_per_second']:.0f} documents/s, {stats['text_mb_per_second']:.2f} MB of text/s; "
+          f"peak RSS {megabytes(stats['peak_rss_mb'])} (this process), {megabytes(stats['peak_worker_rss_mb'])} (largest worker)")
+
+def build_lsa(args):
+    handler = connect(args)
+    engine = SearchEngine(handler, args.table)
+    path = args.output or engine.semantic_path
+    checksum = handler.table_checksum(args.table)
+    started = time.perf_counter()
+    ranker = TfidfRanker(InvertedIndex.build(engine.rows()))
+    lists = args.lists
+    if lists is None:
+        # Brute force is cheaper than probing clusters until the corpus gets large
+        lists = int(4 * math.sqrt(len(ranker.index))) if len(ranker.index) >= 20000 else 0
+    semantic = SemanticIndex.train(ranker, args.dims, lists)
+    if semantic.ann is not None and args.nprobe:
+        semantic.ann.nprobe = args.nprobe
+    size = 0
+    # Written before the metadata, which save() writes last and marks the set complete
+    if args.neighbors:
+        size += NeighborTable.build(semantic, args.neighbors).save(path)
+    else:
+        NeighborTable.remove(path)
+    size += semantic.save(path, checksum)
+    print(f"Wrote {path}.docs.npy, .terms.npy and .json: {semantic.docs.shape[0]} documents x {semantic.docs.shape[1]} dimensions, "
+          f"{len(semantic.terms)} terms, {lists} IVF lists, {args.neighbors} neighbors per document, {size} bytes in {time.perf_counter() - started:.2f}s")
+
+def bench_ann(args):
+    engine = SearchEngine(connect(args), args.table)
+    semantic = SemanticIndex.load(args.semantic or engine.semantic_path, tokenizer = Tokenizer())
+    queries = read_queries(args, None) if args.queries else [row[1] for row in engine.rows()]
+    vectors = [vector for vector in (semantic.query_vector(query) for query in queries) if vector is not None]
+    docs = np.asarray(semantic.docs)
+    if args.copies > 1:
+        # Stand-in for a larger corpus: jittered copies of the real embeddings
+        rng = np.random.RandomState(0)
+        docs = np.concatenate([docs] + [docs + rng.normal(0, args.noise, docs.shape).astype(np.float32) for _ in range(args.copies - 1)])
+        docs = SemanticIndex.normalize_rows(docs).astype(np.float32)
+    semantic.docs = docs
+    lists = args.lists or max(1, int(4 * math.sqrt(len(docs))))
+    started = time.perf_counter()
+    semantic.ann = IvfIndex.build(docs, lists)
+    print(f"{len(vectors)} queries, top-{args.k}, {len(docs)} x {docs.shape[1]} embeddings; {lists} IVF lists built in {time.perf_counter() - started:.2f}s")
+    started = time.perf_counter()
+    expected = [set(row for row, _ in semantic.top_rows(vector, args.k, exact = True)) for vector in vectors]
+    exact_time = time.perf_counter() - started
+    print(f"exact:       recall@{args.k} 1.000  {exact_time * 1000 / len(vectors):.3f} ms/query")
+    nprobe = 1
+    while nprobe <= lists:
+        started = time.perf_counter()
+        found = [set(row for row, _ in semantic.top_rows(vector, args.k, nprobe = nprobe)) for vector in vectors]
+        ann_time = time.perf_counter() - started
+        recall = sum(len(rows & truth) / max(len(truth), 1) for rows, truth in zip(found, expected)) / len(vectors)
+        print(f"nprobe {nprobe:4}: recall@{args.k} {recall:.3f}  {ann_time * 1000 / len(vectors):.3f} ms/query ({exact_time / ann_time:.1f}x)")
+        nprobe *= 2
+
+def bench_wand(args):
+    index = load_index(args)
+    scorer = BM25Scorer(index)
+    queries = read_queries(args, index)
+    stats = {}
+    candidates = 0
+    exhaustive_time = wand_time = 0.0
+    for query in queries:
+        terms = set(index.tokenizer.tokenize(query))
+        candidates += len(set(docno for term in terms if term in index.postings for docno in index.postings[term].docnos))
+        started = time.perf_counter()
+        expected = scorer.rank(query, args.k)
+        exhaustive_time += time.perf_counter() - started
+        started = time.perf_counter()
+        ranked = scorer.rank_wand(query, args.k, stats = stats)
+        wand_time += time.perf_counter() - started
+        if ranked != expected:
+            raise SystemExit(f"WAND result differs from exhaustive scoring for {query!r}")
+    print(f"{len(queries)} queries, top-{args.k}, {len(index)} documents; all WAND results identical to exhaustive BM25")
+    print(f"exhaustive: {candidates} documents scored, {exhaustive_time * 1000 / len(queries):.3f} ms/query")
+    print(f"WAND:       {stats.get('evaluated', 0)} documents scored, {candidates - stats.get('evaluated', 0)} skipped "
+          f"({stats.get('skipped_postings', 0)} postings jumped), {wand_time * 1000 / len(queries):.3f} ms/query")
+
+def bench_typing(args):
+    engine = SearchEngine(connect(args), args.table)
+    engine.build()
+    # Default workload: every title typed one character at a time
+    queries = read_queries(args, engine.index) if args.queries else [row[1] for row in engine.index.rows]
+    keystrokes = [query[:end] for query in queries for end in range(1, len(query) + 1)]
+    print(f"{len(queries)} queries typed as {len(keystrokes)} keystrokes, top-{args.k}, {len(engine.index)} documents")
+    for mode in ("index", "substring"):
+        engine.refinements = None
+        started = time.perf_counter()
+        expected = [engine.search(keystroke, mode, args.k) for keystroke in keystrokes]
+        full_time = time.perf_counter() - started
+        engine.refinements = RefinementCache()
+        started = time.perf_counter()
+        refined = [engine.search(keystroke, mode, args.k) for keystroke in keystrokes]
+        refined_time = time.perf_counter() - started
+        if refined != expected:
+            raise SystemExit(f"refined {mode} results differ from a full search")
+        stats = engine.refinements.stats()
+        print(f"{mode:9}  full search: {full_time * 1000 / len(keystrokes):.3f} ms/keystroke   refined: {refined_time * 1000 / len(keystrokes):.3f} ms/keystroke "
+              f"({full_time / max(refined_time, 1e-9):.1f}x; {stats['refinements']} refined, {stats['hits']} repeated, {stats['misses']} searched in full)")
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", default = "root")
+    parser.add_argument("--password", default = "admin")
+    parser.add_argument("--port", type = int, default = 3306)
+    parser.add_argument("--database", default = "kardashiandb")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--table", default = "episodes")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    build = commands.add_parser("build-index", help = "write the memory-mapped index file the app loads at startup")
+    build.add_argument("--output", help = "index file path (default: indexes/<table>.idx)")
+    build.add_argument("--workers", type = int, help = "worker processes indexing blocks, 0 to index in this process (default: one per CPU)")
+    build.add_argument("--block-mb", type = float, default = 16, help = "text per block; a worker holds the index of one block at a time")
+    build.add_argument("--temp-dir", help = "directory for the partial indexes (default: next to the output file)")
+    build.add_argument("--in-memory", action = "store_true", help = "build the whole index in memory instead of in blocks")
+    build.set_defaults(run = build_index)
+
+    lsa = commands.add_parser("build-lsa", help = "write the LSA embeddings served by mode=semantic")
+    lsa.add_argument("--output", help = "path prefix of the three files (default: indexes/<table>.lsa)")
+    lsa.add_argument("--dims", type = int, default = 128)
+    lsa.add_argument("--lists", type = int, help = "IVF lists for approximate search, 0 for none (default: 4 * sqrt(documents) from 20000 documents on)")
+    lsa.add_argument("--neighbors", type = int, default = 10, help = "similar episodes precomputed per episode for /episodes/<id>/similar, 0 for none")
+    lsa.add_argument("--nprobe", type = int, help = "IVF lists probed per query (default: 8)")
+    lsa.set_defaults(run = build_lsa)
+
+    ann = commands.add_parser("bench-ann", help = "recall@k and latency of IVF search against exact embedding search")
+    ann.add_argument("--semantic", help = "path prefix of the build-lsa files (default: indexes/<table>.lsa)")
+    ann.add_argument("--queries", help = "file with one query per line (default: titles)")
+    ann.add_argument("--lists", type = int, help = "IVF lists (default: 4 * sqrt(documents))")
+    ann.add_argument("--copies", type = int, default = 1, help = "benchmark over this many jittered copies of the embeddings")
+    ann.add_argument("--noise", type = float, default = 0.05)
+    ann.add_argument("-k", type = int, default = 10)
+    ann.set_defaults(run = bench_ann)
+
+    wand = commands.add_parser("bench-wand", help = "compare WAND against exhaustive BM25 scoring")
+    wand.add_argument("--queries", help = "file with one query per line (default: titles and descriptions)")
+    wand.add_argument("-k", type = int, default = 10)
+    wand.set_defaults(run = bench_wand)
+
+    typing = commands.add_parser("bench-typing", help = "time search-as-you-type keystrokes with and without the prefix-refinement cache")
+    typing.add_argument("--queries", help = "file with one query per line (default: titles)")
+    typing.add_argument("-k", type = int, default = 10)
+    typing.set_defaults(run = bench_typing)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
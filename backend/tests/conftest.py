@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app imports its modules as helpers.X from the backend folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
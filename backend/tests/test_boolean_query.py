@@ -0,0 +1,102 @@
+import random
+import pytest
+from helpers.BooleanQuery import BooleanQuery
+from helpers.InvertedIndex import InvertedIndex
+
+ROWS = [
+    (1, "Kim in Paris", "Kim and Kourtney fly to Paris."),
+    (2, "Kim in Mexico", "Kim and Khloe go to Mexico."),
+    (3, "Khloe in Paris", "Khloe visits Paris alone."),
+    (4, "Kourtney at home", "Kourtney stays home with Scott."),
+    (5, "Kim at home", "Kim stays home; Khloe calls from Paris."),
+]
+
+@pytest.fixture
+def index():
+    return InvertedIndex.build(ROWS)
+
+@pytest.fixture
+def boolean(index):
+    return BooleanQuery(index.tokenizer)
+
+def ids(boolean, index, query):
+    return sorted(index.rows[docno][0] for docno in boolean.evaluate(index, boolean.plan(query)))
+
+def test_precedence(boolean):
+    # NOT binds tighter than AND, AND (explicit or implicit) tighter than OR
+    assert repr(boolean.parse("kim AND (paris OR mexico) NOT khloe")) == "(kim AND (paris OR mexico) AND NOT khloe)"
+    assert repr(boolean.parse("kim paris OR khloe")) == "((kim AND paris) OR khloe)"
+    assert repr(boolean.parse("kim OR khloe AND paris")) == "(kim OR (khloe AND paris))"
+    assert repr(boolean.parse("NOT NOT kim")) == "NOT NOT kim"
+
+def test_evaluation(boolean, index):
+    assert ids(boolean, index, "kim AND (paris OR mexico) NOT khloe") == [1]
+    assert ids(boolean, index, "kim OR kourtney") == [1, 2, 4, 5]
+    assert ids(boolean, index, "(kim OR kourtney) AND home NOT scott") == [5]
+    assert ids(boolean, index, 'kim AND "stays home"') == [5]
+    assert ids(boolean, index, "kim AND unknownterm") == []
+    assert ids(boolean, index, "kim OR unknownterm") == [1, 2, 5]
+
+def test_not_only_queries(boolean, index):
+    assert ids(boolean, index, "NOT kim") == [3, 4]
+    assert ids(boolean, index, "NOT kim NOT khloe") == [4]
+    assert ids(boolean, index, "NOT unknownterm") == [1, 2, 3, 4, 5]
+    assert ids(boolean, index, "paris OR NOT kim") == [1, 3, 4, 5]
+
+def test_stray_and_unclosed_parentheses(boolean, index):
+    assert ids(boolean, index, "(kim OR khloe") == ids(boolean, index, "kim OR khloe")
+    assert ids(boolean, index, ") kim") == ids(boolean, index, "kim")
+    assert ids(boolean, index, "kim ) paris") == ids(boolean, index, "kim paris")
+    assert boolean.parse("()") is None
+    assert boolean.parse("NOT") is None
+    assert boolean.parse("AND OR") is None
+    assert boolean.parse("kim AND") is not None
+
+def test_deleted_documents_never_match(boolean, index):
+    index.delete(1)
+    assert ids(boolean, index, "kim paris") == [5]
+    assert ids(boolean, index, "NOT khloe") == [4]
+
+def test_near_composes_with_operators(boolean, index):
+    assert repr(boolean.parse("kim NEAR/3 paris AND khloe")) == "(kim NEAR/3 paris AND khloe)"
+    assert ids(boolean, index, "kim NEAR/3 paris") == [1]
+    assert ids(boolean, index, "kim NEAR/3 paris OR khloe NEAR/2 paris") == [1, 3]
+    assert ids(boolean, index, "kim NEAR/6 paris AND khloe") == [5]
+    assert ids(boolean, index, "kim NEAR/2 kourtney NEAR/3 paris") == [1]
+    assert ids(boolean, index, "(kim NEAR/3 paris) OR NOT kim") == [1, 3, 4]
+    # NEAR/k without an operand on either side is dropped
+    assert ids(boolean, index, "NEAR/2 kim AND paris") == ids(boolean, index, "kim paris")
+    assert ids(boolean, index, "kim AND paris NEAR/2") == ids(boolean, index, "kim paris")
+
+def test_search_ranks_and_caches_plans(boolean, index):
+    results = boolean.search(index, "kim AND (paris OR mexico)", 10)
+    assert sorted(result["id"] for result in results) == [1, 2, 5]
+    boolean.search(index, "kim AND (paris OR mexico)", 10)
+    assert boolean.stats()["plan_cache_hits"] == 1
+    assert boolean.stats()["plan_cache_misses"] == 1
+
+@pytest.mark.parametrize("a, b", [
+    ([], []), ([], [1, 2]), ([1, 2], []), ([1], [1]), ([0], [5]), ([5], [0]),
+    ([1, 2, 3], [3]), ([3], [1, 2, 3]), ([1, 3, 5, 7], [2, 4, 6, 8]),
+    (list(range(0, 1000, 3)), [999]), ([2], list(range(1000))),
+])
+def test_set_operations_edge_cases(a, b):
+    assert BooleanQuery.intersect(a, b) == sorted(set(a) & set(b))
+    assert BooleanQuery.difference(a, b) == sorted(set(a) - set(b))
+    assert BooleanQuery.union([a, b]) == sorted(set(a) | set(b))
+
+def test_set_operations_random():
+    rng = random.Random(0)
+    for _ in range(200):
+        a = sorted(rng.sample(range(500), rng.randrange(50)))
+        b = sorted(rng.sample(range(500), rng.randrange(300)))
+        assert BooleanQuery.intersect(a, b) == sorted(set(a) & set(b))
+        assert BooleanQuery.difference(a, b) == sorted(set(a) - set(b))
+        assert BooleanQuery.union([a, b, a]) == sorted(set(a) | set(b))
+
+def test_gallop_returns_first_position_at_or_after_target():
+    docnos = [1, 3, 5, 7, 9, 11]
+    for lo in range(len(docnos) + 1):
+        for target in range(13):
+            expected = next((i for i in range(lo, len(docnos)) if docnos[i] >= target), len(docnos))
+            assert BooleanQuery.gallop(docnos, target, lo) == expected
@@ -0,0 +1,50 @@
+import pytest
+from helpers.InvertedIndex import InvertedIndex
+
+ROWS = [
+    (1, "Kim and Kourtney", "Kim flies to Paris with Kourtney and Khloe."),
+    (2, "Sex Tape", "Kim's sex tape leaks; Khloe stays home."),
+    (3, "Tape Sex", "A sex shop opens next to the tape store in Paris."),
+    (4, "Paris", "Kourtney, Kim and Khloe argue about the trip to Paris."),
+]
+
+@pytest.fixture
+def index():
+    return InvertedIndex.build(ROWS)
+
+def ids(results):
+    return sorted(result["id"] for result in results)
+
+def test_phrase_matches_consecutive_terms_only(index):
+    assert ids(index.search('"sex tape"')) == [2]
+    assert ids(index.search('"tape sex"')) == [3]
+
+def test_phrase_does_not_span_title_and_description(index):
+    # Title "Paris" is followed by a description starting with "Kourtney"
+    assert ids(index.search('"paris kourtney"')) == []
+
+def test_unclosed_quote_is_a_phrase_to_the_end(index):
+    assert ids(index.search('"sex tape')) == [2]
+    assert index.matches('"sex tape') == index.matches('"sex tape"')
+
+def test_near(index):
+    assert ids(index.search("kim NEAR/2 kourtney ")) == [1, 4]
+    assert ids(index.search("kim NEAR/1 paris ")) == []
+    assert ids(index.search("paris NEAR/1 kim ")) == []
+    assert ids(index.search("kourtney NEAR/2 kim ")) == [1, 4]
+
+def test_chained_near(index):
+    clauses, rest = index.parse_clauses("kim NEAR/2 kourtney NEAR/2 khloe")
+    assert clauses == [(["kim", "kourtney"], 2), (["kourtney", "khloe"], 2)]
+    assert not index.tokenizer.tokenize(rest)
+    assert ids(index.search("kim NEAR/2 kourtney NEAR/2 khloe")) == [1]
+    assert ids(index.search("kim NEAR/2 kourtney NEAR/3 khloe")) == [1, 4]
+
+def test_near_with_plain_terms(index):
+    assert ids(index.search("kim NEAR/3 kourtney trip ")) == [4]
+
+def test_structured_queries_are_not_normalized(index):
+    for query in ('"sex tape"', "kim NEAR/2 kourtney", "kim AND paris"):
+        assert InvertedIndex.is_structured(query)
+        assert index.query_key(query) == ""
+    assert index.query_key("Kim  Paris ") == "kim paris "
@@ -0,0 +1,101 @@
+import os
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from helpers.IndexFile import IndexFile, IndexFileError, MappedIndex
+from helpers.InvertedIndex import InvertedIndex
+from helpers.SearchEngine import SearchEngine
+
+ROWS = [
+    (1, "Kim and Kourtney", "Kim flies to Paris with Kourtney and Khloe."),
+    (2, "Sex Tape", "Kim's sex tape leaks; Khloe stays home."),
+    (3, "Kardashian Christmas", "The Kardashian family spends Christmas with Kris."),
+    (4, "Paris", "Kourtney, Kim and Khloe argue about the trip to Paris."),
+    (5, "Kardashian Vacation", "Khloe and Kourtney take a Kardashian vacation in Mexico."),
+]
+
+class Handler(object):
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def query_streamer(self, query, params = None, batch_size = 1000):
+        yield list(self.rows)
+
+    def table_checksum(self, table):
+        return 0
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = SearchEngine(Handler(ROWS), index_path = str(tmp_path / "episodes.idx"))
+    engine.build()
+    return engine
+
+def ids(results):
+    return sorted(result["id"] for result in results)
+
+def test_suggest_keeps_query_syntax(engine):
+    assert engine.suggest("kardashain AND NOT kim ") == "kardashian AND NOT kim "
+    assert engine.suggest('"kardashain vacation" NEAR/2 mexico ') == '"kardashian vacation" NEAR/2 mexico '
+    assert ids(engine.search(engine.suggest("kardashain AND NOT kim "))) == [3, 5]
+    assert engine.suggest("kim AND khloe ") is None
+
+def test_cosine_follows_writes(engine):
+    assert ids(engine.search("vacation mexico", "cosine")) == [5]
+    engine.apply_changes("episodes", [("upsert", 5, (5, "Kardashian Vacation", "Khloe and Kourtney take a Kardashian vacation in Bora Bora."))])
+    assert ids(engine.search("vacation bora", "cosine")) == [5]
+    assert ids(engine.search("mexico", "cosine")) == []
+    engine.apply_changes("episodes", [("upsert", 6, (6, "Mexico", "Kim goes to Mexico."))])
+    assert ids(engine.search("mexico", "cosine")) == [6]
+    engine.apply_changes("episodes", [("delete", 6, None)])
+    assert ids(engine.search("mexico", "cosine")) == []
+
+def test_corrupt_index_file_is_rebuilt(tmp_path):
+    path = str(tmp_path / "episodes.idx")
+    IndexFile.write(InvertedIndex.build(ROWS), path)
+    with open(path, "r+b") as index_file:
+        index_file.seek(-40, os.SEEK_END)
+        index_file.write(b"\xff" * 8)
+    engine = SearchEngine(Handler(ROWS), index_path = path)
+    engine.build()
+    assert not isinstance(engine.index, MappedIndex)
+    assert ids(engine.search("paris")) == [1, 4]
+
+def test_failed_build_is_retried_from_the_table(tmp_path, monkeypatch):
+    path = str(tmp_path / "episodes.idx")
+    IndexFile.write(InvertedIndex.build(ROWS), path)
+    engine = SearchEngine(Handler(ROWS), index_path = path)
+    failures = []
+    def load_semantic():
+        if not failures:
+            failures.append(engine.built.copy())
+            raise IndexFileError("broken")
+        return None
+    monkeypatch.setattr(engine, "load_semantic", load_semantic)
+    engine.start().join()
+    assert "index" in failures[0]
+    assert engine.available("cosine") and not isinstance(engine.index, MappedIndex)
+    engine.apply_changes("episodes", [("upsert", 6, (6, "Zyzzyva", "A word nobody searches for."))])
+    assert ids(engine.search("zyzzyva")) == [6]
+
+@pytest.mark.parametrize("mode, options", [("bm25", {"k1": -1, "b": 0}), ("bm25", {"k1": -1, "b": 0, "proximity": 1}), ("bm25f", {"k1": -1, "b": 0}),
+                                           ("bm25", {"b": 1.5}), ("bm25", {"proximity": -1})])
+def test_out_of_range_options_are_rejected(engine, mode, options):
+    with pytest.raises(ValueError):
+        engine.search("kim paris", mode, **options)
+
+def test_boundary_options_are_accepted(engine):
+    assert ids(engine.search("kim paris", "bm25", k1 = 0, b = 0)) == [1, 2, 4]
+    assert ids(engine.search("kim paris", "bm25f", k1 = 0, b = 1)) == [1, 2, 4]
+
+def test_listeners_hear_builds_and_merges(tmp_path):
+    engine = SearchEngine(Handler(ROWS), index_path = str(tmp_path / "episodes.idx"))
+    calls = []
+    engine.watch(lambda: calls.append(len(engine.built)))
+    engine.build()
+    assert calls == [len(engine.built)]
+    # As _start_merge() does: changes arriving during the merge are logged for its replay
+    engine.log = []
+    engine.merge()
+    assert len(calls) == 2
@@ -0,0 +1,43 @@
+import random
+import pytest
+from helpers.IndexFile import IndexFile
+from helpers.InvertedIndex import InvertedIndex
+from helpers.SpimiBuilder import SpimiBuilder
+
+WORDS = ["kim", "kourtney", "khloe", "kris", "paris", "tape", "trip", "dash", "Café", "déjà-vu", "l'amour", "sex", "scott", "mason"]
+
+def make_rows(count, seed = 7):
+    generator = random.Random(seed)
+    rows = []
+    for i in range(count):
+        title = " ".join(generator.choice(WORDS) for _ in range(generator.randint(0, 4)))
+        descr = " ".join(generator.choice(WORDS) + generator.choice(["", ",", ".", "!"]) for _ in range(generator.randint(0, 40)))
+        rows.append((i * 3 + 1, title or None, descr or None))
+    return rows
+
+@pytest.fixture(scope = "module")
+def expected(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("in-memory") / "episodes.idx")
+    IndexFile.write(InvertedIndex.build(make_rows(300)), path, 42)
+    with open(path, "rb") as index_file:
+        return index_file.read()
+
+@pytest.mark.parametrize("workers", [0, 2, 3])
+@pytest.mark.parametrize("block_bytes", [500, 3000, 1 << 20])
+def test_same_file_as_in_memory_build(tmp_path, expected, workers, block_bytes):
+    path = str(tmp_path / "index" / "episodes.idx")
+    builder = SpimiBuilder(workers, block_bytes, str(tmp_path))
+    size = builder.build(iter(make_rows(300)), path, 42)
+    with open(path, "rb") as index_file:
+        assert index_file.read() == expected
+    assert size == len(expected)
+    assert builder.stats["documents"] == 300
+    assert builder.stats["runs"] >= (2 if block_bytes < 1 << 20 else 1)
+
+def test_empty_table(tmp_path):
+    expected = str(tmp_path / "expected.idx")
+    IndexFile.write(InvertedIndex.build([]), expected)
+    path = str(tmp_path / "spimi.idx")
+    SpimiBuilder(0).build(iter([]), path)
+    with open(path, "rb") as a, open(expected, "rb") as b:
+        assert a.read() == b.read()
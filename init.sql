@@ -292,3 +292,15 @@ INSERT INTO episodes VALUE(283,'Dishing It Out','The Kardashians show never befo
 INSERT INTO episodes VALUE(284,'10th Anniversary Special','Ryan Seacrest sits down with Kris, Kourtney, Kimberly, Khloe, Kendall, Kylie and Scott to reflect back on the most monumental events in their lives.');
 INSERT INTO episodes VALUE(285,'A Very Kardashian Holiday','The Kardashians prepare for the holiday season bigger and better than ever before.');
 INSERT INTO episodes VALUE(286,'Celebration Continues: Happy 40th Birthday, Kim!','The family celebrates Kim’s 40th birthday.');
+
+ALTER TABLE episodes ADD PRIMARY KEY (id);
+
+ALTER TABLE episodes ADD COLUMN title_norm varchar(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci GENERATED ALWAYS AS (LOWER(title)) STORED;
+
+CREATE INDEX idx_episodes_title_norm ON episodes (title_norm);
+
+CREATE FULLTEXT INDEX ft_episodes_title ON episodes (title);
+
+CREATE FULLTEXT INDEX ft_episodes_descr ON episodes (descr);
+
+CREATE FULLTEXT INDEX ft_episodes_title_descr ON episodes (title, descr);